@@ -1,13 +1,13 @@
 from django.contrib import admin
 import json
-from .models import Website, Category, Product
+from .models import Website, Category, Product, PriceHistory, SweepCursor
 
 class WebsiteAdmin(admin.ModelAdmin):
     list_display = ["name", "domain", "url"]
 
 class CategoryAdmin(admin.ModelAdmin):
-    list_display = ["name", "site", "orig_id", "role", "orig_path", "google_path"]
-    list_editable = ["google_path"]
+    list_display = ["name", "site", "orig_id", "role", "orig_path", "google_path", "deal_threshold"]
+    list_editable = ["google_path", "deal_threshold"]
 class ProductAdmin(admin.ModelAdmin):
     list_display = ["name", "site", "category", "orig_id", "images_count", "is_variant", "skus_count"]
     def images_count(self, obj):
@@ -18,6 +18,13 @@ class ProductAdmin(admin.ModelAdmin):
         skus = obj.skus.split(",")
         return len(skus)
     skus_count.short_description = "Skus"
+class PriceHistoryAdmin(admin.ModelAdmin):
+    list_display = ["sku", "product", "recorded_at", "sale_price", "regular_price", "stock"]
+    raw_id_fields = ["product"]
+class SweepCursorAdmin(admin.ModelAdmin):
+    list_display = ["site", "name", "position", "updated_at"]
 admin.site.register(Website, WebsiteAdmin)
 admin.site.register(Category, CategoryAdmin)
-admin.site.register(Product, ProductAdmin)
\ No newline at end of file
+admin.site.register(Product, ProductAdmin)
+admin.site.register(PriceHistory, PriceHistoryAdmin)
+admin.site.register(SweepCursor, SweepCursorAdmin)
\ No newline at end of file
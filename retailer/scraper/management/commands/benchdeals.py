@@ -0,0 +1,89 @@
+import random
+import time
+from django.core.management.base import BaseCommand, CommandParser
+from .extractor.deals import DealBatch, DEAL_THRESHOLD, parse_price_record
+
+
+def make_records(products, variants):
+    records = []
+    for _ in range(products):
+        skus = []
+        for _ in range(random.randint(1, variants)):
+            regular_price = round(random.uniform(5, 500), 2)
+            sale_price = round(regular_price * random.uniform(0.4, 1.0), 2)
+            skus.append({
+                "originalPrice": {"value": regular_price},
+                "currentPrice": {"value": sale_price},
+                "fulfillment": {"availability": {"Corporate": {"Quantity": random.randint(0, 50)}}},
+            })
+        records.append(skus)
+    return records
+
+def parse_records(records):
+    prices = []
+    for skus in records:
+        product_prices = []
+        for sku in skus:
+            regular_price, sale_price, stock = parse_price_record(sku)
+            product_prices.append((regular_price, sale_price))
+        prices.append(product_prices)
+    return prices
+
+def evaluate_loop(prices, threshold):
+    # the per-variant scalar evaluation the deal scraper used before
+    deals = []
+    for product_prices in prices:
+        discount = 0
+        for regular_price, sale_price in product_prices:
+            new_discount = 0
+            if regular_price > 0 and sale_price > 0 and regular_price > sale_price:
+                new_discount = (regular_price - sale_price) / regular_price * 100
+            if new_discount > discount:
+                discount = new_discount
+        deals.append(discount >= threshold)
+    return deals
+
+def build_batch(prices, threshold):
+    deal_batch = DealBatch()
+    for product_prices in prices:
+        index = deal_batch.add_product(threshold)
+        for regular_price, sale_price in product_prices:
+            deal_batch.add_price(index, regular_price, sale_price)
+    return deal_batch
+
+class Command(BaseCommand):
+    help = "Compare the scalar and the vectorized deal evaluation on synthetic price records"
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--products", type=int, default=100000, help="Number of products")
+        parser.add_argument("--variants", type=int, default=8, help="Max variants per product")
+        parser.add_argument("--threshold", type=float, default=DEAL_THRESHOLD, help="Deal threshold in percent")
+        parser.add_argument("--repeat", type=int, default=3, help="Runs of each evaluator, the best one is reported")
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        records = make_records(options["products"], options["variants"])
+        # parsing is shared by both evaluators, time it once on its own
+        started = time.perf_counter()
+        prices = parse_records(records)
+        self.stdout.write(f" parse : {(time.perf_counter() - started) * 1000:.1f} ms for {len(records)} products")
+        threshold = options["threshold"]
+        deal_batch = build_batch(prices, threshold)
+        timings = {}
+        results = {}
+        # the batch is filled while the records are parsed in the scraper, so filling it is timed apart
+        for name, evaluate in [
+            ("loop", lambda: evaluate_loop(prices, threshold)),
+            ("fill", lambda: build_batch(prices, threshold)),
+            ("numpy", lambda: deal_batch.evaluate()[1].tolist()),
+        ]:
+            best = None
+            for _ in range(options["repeat"]):
+                started = time.perf_counter()
+                results[name] = evaluate()
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = best
+            self.stdout.write(f"{name:>6} : {best * 1000:.1f} ms for {len(records)} products")
+        if results["loop"] != results["numpy"]:
+            self.stdout.write("results differ")
+        self.stdout.write(f"deals : {sum(results['numpy'])}, evaluation speedup : {timings['loop'] / timings['numpy']:.2f}x, with filling : {timings['loop'] / (timings['fill'] + timings['numpy']):.2f}x")
@@ -0,0 +1,40 @@
+import statistics
+import time
+from pathlib import Path
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from .extractor.kms_parser import parse_product_page, stream_product_page
+
+STREAM_CHUNK_SIZE = 16 * 1024
+
+def parse_stream(content):
+    return stream_product_page(content[i:i + STREAM_CHUNK_SIZE] for i in range(0, len(content), STREAM_CHUNK_SIZE))
+
+
+class Command(BaseCommand):
+    help = "Time the kmstools product page parser over saved product pages"
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("pages", type=str, help="Directory of product pages saved as .html files, scraper/testdata/kmspages has a sample")
+        parser.add_argument("--mode", type=str, choices=["tree", "stream"], default="tree", help="Full parse or streamed partial parse")
+        parser.add_argument("--repeat", type=int, default=5, help="Parses of each page, the best one is kept")
+
+    def handle(self, *args, **options):
+        paths = sorted(Path(options["pages"]).glob("*.html"))
+        if len(paths) == 0:
+            raise CommandError(f"no .html files in {options['pages']}")
+        pages = [path.read_bytes() for path in paths]
+        parse = parse_stream if options["mode"] == "stream" else parse_product_page
+        timings = []
+        products = 0
+        for text in pages:
+            best = None
+            for _ in range(options["repeat"]):
+                started = time.perf_counter()
+                result = parse(text)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            timings.append(best * 1000)
+            if result is not None:
+                products += 1
+        size = sum(len(text) for text in pages) / len(pages) / 1024
+        self.stdout.write(f"{len(pages)} pages ({products} products), {size:.0f} KB on average")
+        self.stdout.write(f"per page : mean {statistics.mean(timings):.2f} ms, median {statistics.median(timings):.2f} ms, max {max(timings):.2f} ms")
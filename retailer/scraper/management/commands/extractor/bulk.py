@@ -0,0 +1,48 @@
+from django.db import connection
+
+def upsert(model, objs, unique_fields, update_fields, batch_size = 100):
+    # the same key twice in one statement is rejected by ON CONFLICT backends, keep the last one
+    rows = {}
+    for obj in objs:
+        rows[tuple(getattr(obj, field) for field in unique_fields)] = obj
+    if len(rows) == 0:
+        return []
+    # MySQL upserts on any unique key and refuses an explicit conflict target
+    conflict_target = unique_fields if connection.features.supports_update_conflicts_with_target else None
+    return model.objects.bulk_create(
+        list(rows.values()),
+        batch_size = batch_size,
+        update_conflicts = True,
+        unique_fields = conflict_target,
+        update_fields = update_fields,
+    )
+
+def changed_fields(obj, original, fields):
+    # original is either a snapshot dict or the stored instance of the same row
+    if isinstance(original, dict):
+        return [field for field in fields if getattr(obj, field) != original[field]]
+    return [field for field in fields if getattr(obj, field) != getattr(original, field)]
+
+class DirtyTracker:
+    # snapshots the tracked fields when a row is loaded, then writes only the rows and columns that changed,
+    # one bulk_update per distinct set of changed fields so no statement rewrites columns it does not need to
+    def __init__(self, fields):
+        self.fields = fields
+        self.tracked = []
+
+    def track(self, obj):
+        self.tracked.append((obj, {field: getattr(obj, field) for field in self.fields}))
+
+    def __len__(self):
+        return len(self.tracked)
+
+    def flush(self, model, batch_size = 100):
+        groups = {}
+        for obj, original in self.tracked:
+            dirty = tuple(changed_fields(obj, original, self.fields))
+            if len(dirty) > 0:
+                groups.setdefault(dirty, []).append(obj)
+        for fields, objs in groups.items():
+            model.objects.bulk_update(objs, list(fields), batch_size=batch_size)
+        self.tracked = []
+        return [obj for objs in groups.values() for obj in objs]
@@ -1,7 +1,19 @@
 import requests
 import json
 from scraper.models import Website, Category, Product
-import time
+import math
+import queue
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connection
+from requests.adapters import HTTPAdapter
+from .throttle import throttled_request, DEFAULT_CONCURRENCY, DEFAULT_RATE
+from .bulk import upsert, changed_fields
+from .price_history import PriceHistoryRecorder
+from .category_tree import sync_category_tree, load_leaf_categories
+from .response_cache import ResponseCache, CACHE_DIR, CACHE_TTL
+from .deals import parse_price_record
 
 LANG = "en_CA"
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36 Edg/128.0.0.0"
@@ -11,6 +23,8 @@ API_LOAD_PRODUCT = "/v1/search/search"
 API_GET_PRODUCT = "/v1/product/api/v1/product/productFamily"
 API_GET_PRICE = "/v1/product/api/v1/product/sku/PriceAvailability"
 API_TIMEOUT = 10000
+PRICE_BATCH_SIZE = 200
+PRODUCT_UPDATE_FIELDS = ['sale_price', 'regular_price', 'stock', 'is_variant', 'attributes', 'variants']
 
 class CandianTireScraper:
     def __init__(self) -> None:
@@ -18,9 +32,8 @@ class CandianTireScraper:
         self.session = requests.session()
         self.category_count = 0
         self.product_count = 0
-        
-        self.temp_products_update = []
-        self.temp_products_create = []
+        self.count_lock = threading.Lock()
+        self.cache = None
     
     def create_site(self, name, domain, url):
         try:
@@ -40,161 +53,236 @@ class CandianTireScraper:
         self.settings = settings
         return True
 
+    def get_concurrency(self):
+        return self.settings.get("concurrency", DEFAULT_CONCURRENCY)
+
+    def get_workers(self):
+        return self.settings.get("workers", 1)
+
+    def next_product_count(self):
+        with self.count_lock:
+            self.product_count += 1
+            return self.product_count
+
+    def init_session(self):
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.get_concurrency() * self.get_workers())
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, url, label = "", max_retries = 5, delay = 2, **kwargs):
+        return throttled_request(
+            self.session, method, url,
+            label = label,
+            max_retries = max_retries,
+            delay = delay,
+            max_concurrency = self.get_concurrency(),
+            rate = self.settings.get("rate_limit", DEFAULT_RATE),
+            **kwargs
+        )
+
     def extract_categories(self):
-        resp = self.session.get(
-            f"{self.settings["apiroot"]}{API_LOAD_CATEGORY}", 
+        url = f"{self.settings["apiroot"]}{API_LOAD_CATEGORY}"
+        params = {"lang" : LANG}
+        def fetch(cache_headers):
+            return self.request(
+                "GET",
+                url, 
+                label = "CATEGORY:",
+                ok_statuses = (200, 304),
+                headers = {
+                    "Ocp-Apim-Subscription-Key" : self.settings["apikey"],
+                    "Bannerid": self.settings["id"],
+                    "Basesiteid": self.settings["id"],
+                    "User-Agent": USER_AGENT,
+                    **cache_headers
+                },
+                params = params,
+                timeout = API_TIMEOUT
+            )
+        result = self.cache.get_json(url, params, fetch)
+        if result is None:
+            return []
+        return result.get("categories", [])
+
+    def extract_products(self, category, page, max_tries = 5, delay = 2):
+        url = f"{self.settings["apiroot"]}{API_LOAD_PRODUCT}?store={self.settings['store']}"
+        if page > 1:
+            url += f";page={page}"
+        resp = self.request(
+            "GET",
+            url, 
+            label = "SEARCH:",
+            max_retries = max_tries,
+            delay = delay,
             headers = {
                 "Ocp-Apim-Subscription-Key" : self.settings["apikey"],
                 "Bannerid": self.settings["id"],
                 "Basesiteid": self.settings["id"],
-                "User-Agent": USER_AGENT
+                "User-Agent": USER_AGENT,
+                "Categorycode": category.orig_id,
+                "Categorylevel": f"ast-id-level-{category.level}",
+                "Count": "100",
             },
-            params = {"lang" : LANG},
             timeout = API_TIMEOUT
         )
-        result = resp.json()
-        return result.get("categories", [])
-
-    def extract_products(self, category, page, max_tries = 5, delay = 2):
-        retries = 0
-        while retries < max_tries:
-            try:
-                url = f"{self.settings["apiroot"]}{API_LOAD_PRODUCT}?store={self.settings['store']}"
-                if page > 1:
-                    url += f";page={page}"
-                resp = self.session.get(
-                    url, 
-                    headers = {
-                        "Ocp-Apim-Subscription-Key" : self.settings["apikey"],
-                        "Bannerid": self.settings["id"],
-                        "Basesiteid": self.settings["id"],
-                        "User-Agent": USER_AGENT,
-                        "Categorycode": category.orig_id,
-                        "Categorylevel": f"ast-id-level-{category.level}",
-                        "Count": "100",
-                    },
-                    timeout = API_TIMEOUT
-                )
-                if resp.status_code == 200:
-                    return resp.json()
-            except requests.exceptions.RequestException as e:
-                print(f'Request failed: {e}')
-            retries +=1
-            print(f'Retring... ({retries}/{max_tries})')
-            time.sleep(delay)
-        print('Max retries reached. Could not get a successful response.')
-        return False
+        if resp is None:
+            return False
+        return resp.json()
 
     def extract_product(self, code, max_retries = 5, delay = 2):
-        retries = 0
-        while retries < max_retries:
-            try:
-                resp = self.session.get(
-                    f"{self.settings["apiroot"]}{API_GET_PRODUCT}/{code}", 
-                    headers = {
-                        "Ocp-Apim-Subscription-Key" : self.settings["apikey"],
-                        "Basesiteid": self.settings["id"],
-                        "User-Agent": USER_AGENT
-                    },
-                    params = {
-                        "baseStoreId": self.settings["id"],
-                        "lang": LANG,
-                        "storeId": self.settings["store"]
-                    },
-                    timeout = API_TIMEOUT
-                )
-                if resp.status_code == 200:
-                    return resp.json()
-            except requests.exceptions.RequestException as e:
-                print(f'Request failed: {e}')
-            retries +=1
-            print(f"Retrying... ({retries}/{max_retries})")
-            time.sleep(delay)
-        print("Max retries reached. Could not get a successful response.")
-        return False            
+        url = f"{self.settings["apiroot"]}{API_GET_PRODUCT}/{code}"
+        params = {
+            "baseStoreId": self.settings["id"],
+            "lang": LANG,
+            "storeId": self.settings["store"]
+        }
+        def fetch(cache_headers):
+            return self.request(
+                "GET",
+                url, 
+                label = "PRODUCT:",
+                max_retries = max_retries,
+                delay = delay,
+                ok_statuses = (200, 304),
+                headers = {
+                    "Ocp-Apim-Subscription-Key" : self.settings["apikey"],
+                    "Basesiteid": self.settings["id"],
+                    "User-Agent": USER_AGENT,
+                    **cache_headers
+                },
+                params = params,
+                timeout = API_TIMEOUT
+            )
+        result = self.cache.get_json(url, params, fetch)
+        if result is None:
+            return False
+        return result
     
     def extract_price(self, skus, max_retries = 5, delay = 2):
-        retries = 0
-        while retries < max_retries:
-            try:
-                sku_params = []
-                for sku in skus:
-                    sku_params.append({"code": str(sku), "lowStockThreshold": "0"})
-                    
-                resp = self.session.post(
-                    f"{self.settings["apiroot"]}{API_GET_PRICE}", 
-                    headers = {
-                        "Ocp-Apim-Subscription-Key" : self.settings["apikey"],
-                        "Basesiteid": self.settings["id"],
-                        "Bannerid": self.settings["id"],
-                        "User-Agent": USER_AGENT
-                    },
-                    params = {
-                        "cache": "true",
-                        "lang": LANG,
-                        "storeId": self.settings["store"]
-                    },
-                    json= { "skus":sku_params },
-                    timeout = API_TIMEOUT
-                )
-                if resp.status_code == 200:
-                    return resp.json()
-            except requests.exceptions.RequestException as e:
-                print(f'Request failed: {e}')
-            retries += 1
-            print(f'Retrying... ({retries}/{max_retries})')
-            time.sleep(delay)
-        print('Max retries reached. Could not get a successful response.')
-        return False
+        sku_params = []
+        for sku in skus:
+            sku_params.append({"code": str(sku), "lowStockThreshold": "0"})
+        resp = self.request(
+            "POST",
+            f"{self.settings["apiroot"]}{API_GET_PRICE}", 
+            label = "PRICE:",
+            max_retries = max_retries,
+            delay = delay,
+            headers = {
+                "Ocp-Apim-Subscription-Key" : self.settings["apikey"],
+                "Basesiteid": self.settings["id"],
+                "Bannerid": self.settings["id"],
+                "User-Agent": USER_AGENT
+            },
+            params = {
+                "cache": "true",
+                "lang": LANG,
+                "storeId": self.settings["store"]
+            },
+            json= { "skus":sku_params },
+            timeout = API_TIMEOUT
+        )
+        if resp is None:
+            return False
+        return resp.json()
+
+    def extract_prices(self, executor, skus):
+        batches = [skus[i:i + PRICE_BATCH_SIZE] for i in range(0, len(skus), PRICE_BATCH_SIZE)]
+        price_map = {}
+        for ret in executor.map(self.extract_price, batches):
+            if ret != False:
+                for sku in ret.get("skus", []):
+                    price_map[str(sku["code"])] = sku
+        return price_map
+
+    def get_product_skus(self, result):
+        if result == False:
+            return []
+        return [str(sku["code"]) for sku in result.get("skus", [])]
+
+    def get_price_result(self, result, price_map):
+        prods = [price_map[sku] for sku in self.get_product_skus(result) if sku in price_map]
+        if len(prods) == 0:
+            return False
+        return {"skus": prods}
         
-    def create_category(self, site, cat_info, level, parent = None, parent_paths = []):
+    def collect_category(self, site, cat_info, level, nodes, parent = None, parent_paths = []):
         cat_paths = parent_paths.copy()
         cat_paths.append(cat_info["name"])
-        try:
-            category = Category.objects.get(site=site, orig_id=cat_info["id"])
-            self.category_count += 1
-            category.orig_path = " > ".join(cat_paths)
-            category.save()
-            print("-" * level, f"{self.category_count} : {category.name}: {cat_paths}")
-        except Category.DoesNotExist:
-            role = "leaf"
-            if len(cat_info["subcategories"]) > 0:
-                role ="node"
-            category = Category.objects.create(
-                site = site, 
-                name = cat_info["name"],
-                url = f"{site.url}{cat_info["url"]}",
-                role = role,
-                level = level,
-                orig_id = cat_info["id"],
-                parent = parent,
-                orig_path = " > ".join(cat_paths)
-            )
-            self.category_count += 1
-            print("+" * level, f"{self.category_count} : {category.name}: {cat_paths}")
-        except Exception as e:
-            raise e
+        role = "leaf"
+        if len(cat_info["subcategories"]) > 0:
+            role ="node"
+        nodes.append({
+            "orig_id": cat_info["id"],
+            "parent": parent,
+            "name": cat_info["name"],
+            "url": f"{site.url}{cat_info["url"]}",
+            "role": role,
+            "level": level,
+            "orig_path": " > ".join(cat_paths),
+        })
+        self.category_count += 1
         for subcat in cat_info["subcategories"]:
-            self.create_category(site, subcat, level + 1, category, cat_paths)
+            self.collect_category(site, subcat, level + 1, nodes, cat_info["id"], cat_paths)
     
     def create_categories_for_site(self, site):
         print("make categories ...")
         category_infos = self.extract_categories()
+        nodes = []
         for cat_info in category_infos:
-            self.create_category(site, cat_info, 1)
+            self.collect_category(site, cat_info, 1, nodes)
+        sync_category_tree(site, nodes)
     
     def create_products_for_site(self, site):
-        categories = Category.objects.filter(site=site, parent=None)
+        categories = load_leaf_categories(site)
+        if self.get_workers() > 1:
+            self.crawl_categories_in_parallel(site, categories)
+        else:
+            for category in categories:
+                self.create_products_for_category(site, category)
+
+    def save_total_pages(self, category, total):
+        if category.total_pages != total:
+            category.total_pages = total
+            Category.objects.filter(id=category.id).update(total_pages=total)
+
+    def crawl_categories_in_parallel(self, site, categories):
+        # units are (priority, order, category, page), the biggest categories of the previous run go first and
+        # categories that were never counted go before all of them since they may be just as big
+        work_queue = queue.PriorityQueue()
+        order = itertools.count()
         for category in categories:
-            self.load_products_for_category(site, category)
+            work_queue.put((-(category.total_pages or math.inf), next(order), category, 1))
+        workers = []
+        for _ in range(self.get_workers()):
+            worker = threading.Thread(target=self.crawl_worker, args=(site, work_queue, order))
+            worker.start()
+            workers.append(worker)
+        work_queue.join()
+        for _ in workers:
+            work_queue.put((math.inf, next(order), None, 0))
+        for worker in workers:
+            worker.join()
 
-    def load_products_for_category(self, site, category):
-        if category.role == "node":
-            subcats = Category.objects.filter(site=site, parent=category)
-            for subcat in subcats:
-                self.load_products_for_category(site, subcat)
-        else:
-            self.create_products_for_category(site, category)
+    def crawl_worker(self, site, work_queue, order):
+        try:
+            while True:
+                _, _, category, page = work_queue.get()
+                try:
+                    if category is None:
+                        break
+                    print(f"### CATEGORY ({category.name}): PAGE {page}")
+                    total = self.create_products_for_page(site, category, page)
+                    if total == False:
+                        print(f'*** Reading Products by Category ({category.name}) on Page ({page}) Failed ')
+                    elif page == 1:
+                        self.save_total_pages(category, total)
+                        for next_page in range(2, total + 1):
+                            work_queue.put((-total, next(order), category, next_page))
+                finally:
+                    work_queue.task_done()
+        finally:
+            connection.close()
 
     def create_products_for_category(self, site, category):
         page = 1
@@ -202,6 +290,8 @@ class CandianTireScraper:
             print(f"### CATEGORY ({category.name}): PAGE {page}")
             total = self.create_products_for_page(site, category, page)
             if total != False:
+                if page == 1:
+                    self.save_total_pages(category, total)
                 if page >= total:
                     break
                 page += 1
@@ -214,9 +304,23 @@ class CandianTireScraper:
             result = self.extract_products(category, page)
             if result != False:
                 print(result["pagination"]["total"], ":", result["resultCount"], ":", len(result["products"]))
-                for product_info in result.get("products", []):
+                product_infos = result.get("products", [])
+                existing_products = self.load_existing_products(site, [info["code"] for info in product_infos])
+                with ThreadPoolExecutor(max_workers=self.get_concurrency()) as executor:
+                    product_results = list(executor.map(self.extract_product, [info["code"] for info in product_infos]))
+                    page_skus = []
+                    for product_result in product_results:
+                        page_skus.extend(self.get_product_skus(product_result))
+                    price_map = self.extract_prices(executor, page_skus)
+                page_updates = {}
+                history = PriceHistoryRecorder()
+                for product_info, product_result in zip(product_infos, product_results):
                     try:
-                        success = self.create_product(site, category, product_info)
+                        price_result = self.get_price_result(product_result, price_map)
+                        existing = existing_products.get(product_info["code"])
+                        if existing is not None:
+                            history.track(existing)
+                        success = self.create_product(site, category, product_info, product_result, price_result, existing, page_updates)
                         if success:
                             print(f'{product_info["code"]} : SUCCESS')
                         else:
@@ -224,17 +328,13 @@ class CandianTireScraper:
                     except Exception as e:
                         print(e)
 
-                if len(self.temp_products_create) > 0:
-                    Product.objects.bulk_create(self.temp_products_create, batch_size=100)
-                    self.temp_products_create.clear()
-                else:
-                    print(f'No new product on Page : {page}')
-                
-                if len(self.temp_products_update) > 0:
-                    Product.objects.bulk_update(self.temp_products_update, ['sale_price', 'regular_price', 'stock', 'attributes', 'variants'])
-                    self.temp_products_update.clear()
+                if len(page_updates) > 0:
+                    # one upsert per set of changed fields, new rows carry every field
+                    for fields, products in page_updates.items():
+                        upsert(Product, products, ['site', 'orig_id'], list(fields))
                 else:
-                    print(f'No updated product on Page : {page}')
+                    print(f'No changed product on Page : {page}')
+                self.record_history(site, history, page_updates)
                 
                 return result["pagination"]["total"]
             else:
@@ -243,264 +343,101 @@ class CandianTireScraper:
             print(e)
             return False
         
-    def create_product(self, site, category, product_info):
-        try:
-            product = Product.objects.get(site=site, orig_id=product_info["code"])
-            
-            result = self.extract_product(product_info["code"])
-            
-            if result !=False:
-                is_variant = False
-                if "options" in result:
-                    is_variant = len(result["options"]) > 0
-                    attributes = {}
-                    optionid_attr_maps = {}
-                    for option in result["options"]:
-                        values = []
-                        for value in option["values"]:
-                            optionid_attr_maps[value["id"]] = {"key" : option["display"], "value":value["value"]}
-                            values.append(value["value"])
-                        attributes[option["display"]] = values
-                
-                skus = []
-                sku_attrs_map = {}
-                if "skus" in result:
-                    for sku in result["skus"]:
-                        skus.append(sku["code"])
-                        attrs = {}             
-                        for optionid in sku["optionIds"]:
-                            attr = optionid_attr_maps[optionid]
-                            attrs[attr["key"]] = attr["value"]
-                        sku_attrs_map[sku["code"]] = attrs
-                
-                ret = self.extract_price(skus)
-                if ret != False:
-                    prods = ret["skus"]
+    def load_existing_products(self, site, codes):
+        products = Product.objects.filter(site=site, orig_id__in=codes).only("id", "orig_id", "name", "skus", *PRODUCT_UPDATE_FIELDS)
+        return {product.orig_id: product for product in products}
 
-                    if is_variant:
-                        new_variants = []
+    def record_history(self, site, history, page_updates):
+        # the upsert does not hand back ids on MySQL, they are read again by orig_id for the history rows
+        products = [product for products in page_updates.values() for product in products]
+        if len(products) > 0:
+            ids = dict(Product.objects.filter(site=site, orig_id__in=[product.orig_id for product in products]).values_list("orig_id", "id"))
+            for product in products:
+                product.id = ids.get(product.orig_id)
+        recorded = history.flush(products)
+        if len(recorded) > 0:
+            print(f"{len(recorded)} price history rows")
 
-                        for sku in prods:
-                            variant = {}
-                            variant["sku"] = sku["code"]
-                            if "originalPrice" in sku and sku["originalPrice"] is not None and "value" in sku["originalPrice"] and sku["originalPrice"]["value"] is not None:
-                                variant["regular_price"] = sku["originalPrice"]["value"]
-                            else:
-                                variant["regular_price"] = 0
-                            if "currentPrice" in sku and "value" in sku["currentPrice"] and sku["currentPrice"]["value"] is not None:
-                                variant["sale_price"] = sku["currentPrice"]["value"]
-                            else:
-                                variant["sale_price"] = 0
-                            if "fulfillment" in sku and "availability" in sku["fulfillment"] and "Corporate" in sku["fulfillment"]["availability"] and "Quantity" in sku["fulfillment"]["availability"]["Corporate"]:
-                                variant["stock"] = sku["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                            elif "fulfillment" in sku and "availability" in sku["fulfillment"] and "quantity" in sku["fulfillment"]["availability"]:
-                                variant["stock"] = sku["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                            else:
-                                variant["stock"] = 0
-                            variant["attributes"] = sku_attrs_map[sku["code"]]
-                            
-                            new_variants.append(variant)
-                            
-                        product.variants = json.dumps(new_variants)
-                        product.attributes = json.dumps(attributes)
-                        product.is_variant = True
-                        
-                    else:
-                        sku = prods[0]
-                        if "originalPrice" in sku and sku["originalPrice"] is not None and "value" in sku["originalPrice"] and sku["originalPrice"]["value"] is not None:
-                            regular_price = sku["originalPrice"]["value"]
-                        else:
-                            regular_price = 0
-                        if "currentPrice" in sku and "value" in sku["currentPrice"] and sku["currentPrice"]["value"] is not None:
-                            sale_price = sku["currentPrice"]["value"]
-                        else:
-                            sale_price = 0
-                        if "fulfillment" in sku and "availability" in sku["fulfillment"] and "Corporate" in sku["fulfillment"]["availability"] and "Quantity" in sku["fulfillment"]["availability"]["Corporate"]:
-                            stock = sku["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                        elif "fulfillment" in sku and "availability" in sku["fulfillment"] and "quantity" in sku["fulfillment"]["availability"]:
-                            stock = sku["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                        else:
-                            stock = 0
-                        
-                        product.regular_price = regular_price
-                        product.sale_price = sale_price
-                        product.stock = stock
-                        product.is_variant = False
-                    
-                    self.temp_products_update.append(product)
-                    self.product_count += 1
-                    print(f"---Existing Product {self.product_count} : {product.name} was updated ")
-                    return True
-                else:
-                    return False
-            else:
-                return False
-        except Product.DoesNotExist:
-            result = self.extract_product(product_info["code"])
-            if result != False:
-                features = []
-                if "featureBullets" in result:
-                    for feature in result["featureBullets"]:
-                        features.append(feature.get("description", ""))
-                specifications = {}
-                if "specifications" in result:
-                    for spec in result["specifications"]:
-                        specifications[spec["label"]] = spec["value"]
-                if "images" in result:
-                    images = []
-                    for image in result["images"]:
-                        images.append(image["url"])
-                is_variant = False
-                if "options" in result:
-                    is_variant = len(result["options"]) > 0
-                    attributes = {}
-                    optionid_attr_maps = {}
-                    for option in result["options"]:
-                        values = []
-                        for value in option["values"]:
-                            optionid_attr_maps[value["id"]] = {"key" : option["display"], "value":value["value"]}
-                            values.append(value["value"])
-                        attributes[option["display"]] = values
-                skus = []
-                sku_attrs_map = {}
-                if "skus" in result:
-                    for sku in result["skus"]:
-                        skus.append(sku["code"])
-                        attrs = {}             
-                        for optionid in sku["optionIds"]:
-                            attr = optionid_attr_maps[optionid]
-                            attrs[attr["key"]] = attr["value"]
-                        sku_attrs_map[sku["code"]] = attrs
-                        
-                ret = self.extract_price(skus)
-                if ret != False:
-                    prods = ret["skus"]
-                    if is_variant:
-                        variants = []
-                        for sku in prods:
-                            variant = {}
-                            variant["sku"] = sku["code"]
-                            if "originalPrice" in sku and sku["originalPrice"] is not None and "value" in sku["originalPrice"] and sku["originalPrice"]["value"] is not None:
-                                variant["regular_price"] = sku["originalPrice"]["value"]
-                            else:
-                                variant["regular_price"] = 0
-                            if "currentPrice" in sku and "value" in sku["currentPrice"] and sku["currentPrice"]["value"] is not None:
-                                variant["sale_price"] = sku["currentPrice"]["value"]
-                            else:
-                                variant["sale_price"] = 0
-                            if "fulfillment" in sku and "availability" in sku["fulfillment"] and "Corporate" in sku["fulfillment"]["availability"] and "Quantity" in sku["fulfillment"]["availability"]["Corporate"]:
-                                variant["stock"] = sku["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                            elif "fulfillment" in sku and "availability" in sku["fulfillment"] and "quantity" in sku["fulfillment"]["availability"]:
-                                variant["stock"] = sku["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                            else:
-                                variant["stock"] = 0
-                            variant["attributes"] = sku_attrs_map[sku["code"]]
-                            variants.append(variant)
-                            
-                        self.temp_products_create.append(
-                            Product(
-                                site = site, 
-                                category = category,
-                                name = result["name"],
-                                brand = result["brand"]["label"],
-                                url = f"{self.settings["url"]}{result["canonicalUrl"]}",
-                                description = result["longDescription"],
-                                specification = json.dumps(specifications),
-                                features = json.dumps(features),
-                                images = json.dumps(images),
-                                is_variant = is_variant,
-                                orig_id = product_info["code"],
-                                skus = ",".join(skus),
-                                status = "off",
-                                attributes = json.dumps(attributes),
-                                variants = json.dumps(variants),
-                                is_deal = False
-                            )
-                        )
-                        # Product.objects.create(
-                        #     site = site, 
-                        #     category = category,
-                        #     name = result["name"],
-                        #     brand = result["brand"]["label"],
-                        #     url = f"{self.settings["url"]}{result["canonicalUrl"]}",
-                        #     description = result["longDescription"],
-                        #     specification = json.dumps(specifications),
-                        #     features = json.dumps(features),
-                        #     images = json.dumps(images),
-                        #     is_variant = is_variant,
-                        #     orig_id = product_info["code"],
-                        #     skus = ",".join(skus),
-                        #     status = "off",
-                        #     attributes = json.dumps(attributes),
-                        #     variants = json.dumps(variants),
-                        #     is_deal = False
-                        # )
-                    else:
-                        sku = prods[0]
-                        if "originalPrice" in sku and sku["originalPrice"] is not None and "value" in sku["originalPrice"] and sku["originalPrice"]["value"] is not None:
-                            regular_price = sku["originalPrice"]["value"]
-                        else:
-                            regular_price = 0
-                        if "currentPrice" in sku and "value" in sku["currentPrice"] and sku["currentPrice"]["value"] is not None:
-                            sale_price = sku["currentPrice"]["value"]
-                        else:
-                            sale_price = 0
-                        if "fulfillment" in sku and "availability" in sku["fulfillment"] and "Corporate" in sku["fulfillment"]["availability"] and "Quantity" in sku["fulfillment"]["availability"]["Corporate"]:
-                            stock = sku["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                        elif "fulfillment" in sku and "availability" in sku["fulfillment"] and "quantity" in sku["fulfillment"]["availability"]:
-                            stock = sku["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                        else:
-                            stock = 0
-                        
-                        self.temp_products_create.append(
-                            Product(
-                                site = site, 
-                                category = category,
-                                name = result["name"],
-                                brand = result["brand"]["label"],
-                                url = f"{self.settings["url"]}{result["canonicalUrl"]}",
-                                description = result["longDescription"],
-                                specification = json.dumps(specifications),
-                                features = json.dumps(features),
-                                images = json.dumps(images),
-                                is_variant = False,
-                                orig_id = product_info["code"],
-                                skus = ",".join(skus),
-                                status = "off",
-                                regular_price = regular_price,
-                                sale_price = sale_price,
-                                stock = stock,
-                                is_deal = False
-                            )
-                        )
-                        # Product.objects.create(
-                        #     site = site, 
-                        #     category = category,
-                        #     name = result["name"],
-                        #     brand = result["brand"]["label"],
-                        #     url = f"{self.settings["url"]}{result["canonicalUrl"]}",
-                        #     description = result["longDescription"],
-                        #     specification = json.dumps(specifications),
-                        #     features = json.dumps(features),
-                        #     images = json.dumps(images),
-                        #     is_variant = False,
-                        #     orig_id = product_info["code"],
-                        #     skus = ",".join(skus),
-                        #     status = "off",
-                        #     regular_price = regular_price,
-                        #     sale_price = sale_price,
-                        #     stock = stock,
-                        #     is_deal = False
-                        # )
-                    self.product_count += 1
-                    print(f"+++ PRODUCT {self.product_count} : {result["name"]}")
-                    return True
-                else:
-                    return False
-            else:
-                return False
-        except Exception as e:
-            raise e
+    def create_product(self, site, category, product_info, result, ret, existing, page_updates):
+        if result == False or ret == False:
+            return False
+        features = []
+        if "featureBullets" in result:
+            for feature in result["featureBullets"]:
+                features.append(feature.get("description", ""))
+        specifications = {}
+        if "specifications" in result:
+            for spec in result["specifications"]:
+                specifications[spec["label"]] = spec["value"]
+        images = []
+        if "images" in result:
+            for image in result["images"]:
+                images.append(image["url"])
+        is_variant = False
+        attributes = {}
+        optionid_attr_maps = {}
+        if "options" in result:
+            is_variant = len(result["options"]) > 0
+            for option in result["options"]:
+                values = []
+                for value in option["values"]:
+                    optionid_attr_maps[value["id"]] = {"key" : option["display"], "value":value["value"]}
+                    values.append(value["value"])
+                attributes[option["display"]] = values
+        skus = []
+        sku_attrs_map = {}
+        if "skus" in result:
+            for sku in result["skus"]:
+                skus.append(sku["code"])
+                attrs = {}             
+                for optionid in sku["optionIds"]:
+                    attr = optionid_attr_maps[optionid]
+                    attrs[attr["key"]] = attr["value"]
+                sku_attrs_map[sku["code"]] = attrs
+
+        product = Product(
+            site = site, 
+            category = category,
+            name = result["name"],
+            brand = result["brand"]["label"],
+            url = f"{self.settings["url"]}{result["canonicalUrl"]}",
+            description = result["longDescription"],
+            specification = json.dumps(specifications),
+            features = json.dumps(features),
+            images = json.dumps(images),
+            is_variant = is_variant,
+            orig_id = product_info["code"],
+            skus = ",".join(skus),
+            status = "off",
+            is_deal = False
+        )
+        prods = ret["skus"]
+        if is_variant:
+            variants = []
+            for sku in prods:
+                variant = {}
+                variant["sku"] = sku["code"]
+                variant["regular_price"], variant["sale_price"], variant["stock"] = parse_price_record(sku)
+                variant["attributes"] = sku_attrs_map[sku["code"]]
+                variants.append(variant)
+            product.variants = json.dumps(variants)
+            product.attributes = json.dumps(attributes)
+        else:
+            sku = prods[0]
+            product.regular_price, product.sale_price, product.stock = parse_price_record(sku)
+
+        count = self.next_product_count()
+        if existing is not None:
+            fields = tuple(changed_fields(product, existing, PRODUCT_UPDATE_FIELDS))
+            if len(fields) == 0:
+                print(f"===Existing Product {count} : {existing.name} is unchanged ")
+                return True
+            page_updates.setdefault(fields, []).append(product)
+            print(f"---Existing Product {count} : {existing.name} was updated ")
+        else:
+            page_updates.setdefault(tuple(PRODUCT_UPDATE_FIELDS), []).append(product)
+            print(f"+++ PRODUCT {count} : {product.name}")
+        return True
     
     def start(self):
         # try :
@@ -508,9 +445,12 @@ class CandianTireScraper:
         if self.settings is None:
             print(f"settings should be setted, first.")
             return
+        self.init_session()
+        self.cache = ResponseCache(self.settings.get("cache_dir", CACHE_DIR), self.settings.get("cache_ttl", CACHE_TTL))
         site = self.create_site(self.settings["name"], self.settings["domain"], self.settings["url"]) 
         self.create_categories_for_site(site)
         self.create_products_for_site(site)
+        print(self.cache.report())
         
         self.product_count = 0
         # except Exception as e:
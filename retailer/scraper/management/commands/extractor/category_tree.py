@@ -0,0 +1,57 @@
+from django.db import transaction
+from scraper.models import Category
+
+def sync_category_tree(site, nodes):
+    # nodes come parents-first, each one a dict with orig_id, parent (orig_id of the parent or None),
+    # name, url, role, level and orig_path
+    # the same orig_id can come more than once (kmstools builds ids from name and level), the last node wins
+    nodes = list({node["orig_id"]: node for node in nodes}.values())
+    with transaction.atomic():
+        stored = {category.orig_id: category for category in Category.objects.filter(site=site)}
+        new_categories = []
+        for node in nodes:
+            if node["orig_id"] not in stored:
+                new_categories.append(Category(
+                    site = site,
+                    name = node["name"],
+                    url = node["url"],
+                    role = node["role"],
+                    level = node["level"],
+                    orig_id = node["orig_id"],
+                    orig_path = node["orig_path"]
+                ))
+        if len(new_categories) > 0:
+            Category.objects.bulk_create(new_categories, batch_size=500)
+            # MySQL does not hand back the new ids, read them again to link parents
+            stored = {category.orig_id: category for category in Category.objects.filter(site=site)}
+
+        created = {category.orig_id for category in new_categories}
+        changed = []
+        for node in nodes:
+            category = stored[node["orig_id"]]
+            parent_id = stored[node["parent"]].id if node["parent"] is not None else None
+            if category.orig_path != node["orig_path"] or category.parent_id != parent_id:
+                category.orig_path = node["orig_path"]
+                category.parent_id = parent_id
+                changed.append(category)
+            mark = "+" if node["orig_id"] in created else "-"
+            print(mark * node["level"], f"{category.name}: {node['orig_path']}")
+        if len(changed) > 0:
+            Category.objects.bulk_update(changed, ['orig_path', 'parent'], batch_size=500)
+    updated = len([category for category in changed if category.orig_id not in created])
+    print(f"categories : {len(nodes)} synced, {len(created)} created, {updated} updated")
+
+def load_leaf_categories(site):
+    # one query for the whole table, leaves come out in the same depth-first order as the stored tree
+    children = {}
+    for category in Category.objects.filter(site=site).order_by('id'):
+        children.setdefault(category.parent_id, []).append(category)
+    leaves = []
+    stack = list(reversed(children.get(None, [])))
+    while len(stack) > 0:
+        category = stack.pop()
+        if category.role == "node":
+            stack.extend(reversed(children.get(category.id, [])))
+        else:
+            leaves.append(category)
+    return leaves
@@ -1,8 +1,11 @@
 import requests
 import json
 from scraper.models import Website, Category, Product
-import re
-import time
+from .throttle import throttled_request, DEFAULT_CONCURRENCY, DEFAULT_RATE
+from .bulk import DirtyTracker
+from .price_history import PriceHistoryRecorder
+from .price_api import PriceFetcher, BatchRejected, REJECTED_STATUSES
+from .deals import DealBatch, DEAL_THRESHOLD, load_deal_thresholds, parse_price_record
 
 LANG = "en_CA"
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:129.0) Gecko/20100101 Firefox/129.0"
@@ -11,6 +14,9 @@ API_LOAD_PRODUCT = "/v1/search/search"
 API_GET_PRODUCT = "/v1/product/api/v1/product/productFamily"
 API_GET_PRICE = "/v1/product/api/v1/product/sku/PriceAvailability"
 API_TIMEOUT = 10000
+DEAL_UPDATE_FIELDS = ['sale_price', 'regular_price', 'stock', 'is_deal', 'variants']
+DEAL_BATCH_SIZE = 500
+DEAL_PRODUCT_FIELDS = ['id', 'orig_id', 'category_id', 'skus', 'is_variant'] + DEAL_UPDATE_FIELDS
 
 class DealCandianTireScraper:
     def __init__(self) -> None:
@@ -19,8 +25,14 @@ class DealCandianTireScraper:
         self.category_count = 0
         self.product_count = 0
         self.site = None
-        self.all_deals = []
-        self.temp_products_update= []
+        # orig_id -> product for the current cycle: the old deals plus everything on the deal pages
+        self.all_deals = {}
+        self.deal_thresholds = {}
+        # codes on the deal pages that are not in our catalog yet
+        self.unknown_codes = []
+        self.tracker = DirtyTracker(DEAL_UPDATE_FIELDS)
+        self.history = PriceHistoryRecorder()
+        self.price_fetcher = PriceFetcher(self.get_price_response)
 
     def get_site_id(self, name):
         try:
@@ -30,13 +42,7 @@ class DealCandianTireScraper:
             return False
 
     def change_old2new_inlist(self, orig_id):
-        found = False
-
-        for item in self.all_deals:
-            if item.orig_id == orig_id:
-                found = True
-                break
-        return found
+        return orig_id in self.all_deals
     
     def set_settings(self, settings):
         for key in ["name", "domain", "url", "label", "id", "store", "apikey", "apiroot"]:
@@ -48,38 +54,35 @@ class DealCandianTireScraper:
 
     def reverse_old_deals(self):
         self.site = self.get_site_id(self.settings["name"])
-        old_deal_products = Product.objects.filter( site = self.site, is_deal = True )
-        self.all_deals.extend(old_deal_products)
+        old_deal_products = Product.objects.filter( site = self.site, is_deal = True ).only(*DEAL_PRODUCT_FIELDS)
+        self.all_deals = {product.orig_id: product for product in old_deal_products}
 
     def get_product_response(self, url, max_retries = 5 , delay = 2):
-        retries = 0
-        while retries < max_retries:
-            try:
-                resp = self.session.get(
-                    url, 
-                    headers = {
-                        "Ocp-Apim-Subscription-Key" : self.settings["apikey"],
-                        "Bannerid": self.settings["id"],
-                        "Basesiteid": self.settings["id"],
-                        "User-Agent": USER_AGENT,
-                        "Count": "100",
-                        "Q" : self.settings.get("query", None),
-                        "experience" : self.settings.get("experience", None),
-                        "hidefacets" : self.settings.get("hidefacets",None),
-                        "widgetid" : self.settings.get("widgetid", None),
-                    },
-                    timeout = API_TIMEOUT
-                )
-                if resp.status_code == 200:
-                    return resp.json()
-            except requests.exceptions.RequestException as e:
-                print(f"Request failed: {e}")
-            retries += 1
-            print(f"PRODUCT:Retrying... ({retries}/{max_retries})")
-            time.sleep(delay)
-            
-        print("Max retries reached. Could not get a successful response.")
-        return None    
+        resp = throttled_request(
+            self.session,
+            "GET",
+            url, 
+            label = "PRODUCT:",
+            max_retries = max_retries,
+            delay = delay,
+            max_concurrency = self.settings.get("concurrency", DEFAULT_CONCURRENCY),
+            rate = self.settings.get("rate_limit", DEFAULT_RATE),
+            headers = {
+                "Ocp-Apim-Subscription-Key" : self.settings["apikey"],
+                "Bannerid": self.settings["id"],
+                "Basesiteid": self.settings["id"],
+                "User-Agent": USER_AGENT,
+                "Count": "100",
+                "Q" : self.settings.get("query", None),
+                "experience" : self.settings.get("experience", None),
+                "hidefacets" : self.settings.get("hidefacets",None),
+                "widgetid" : self.settings.get("widgetid", None),
+            },
+            timeout = API_TIMEOUT
+        )
+        if resp is None:
+            return None
+        return resp.json()
 
     def extract_products(self, page):
         url = f"{self.settings['apiroot']}{API_LOAD_PRODUCT}?store={self.settings['store']}"
@@ -90,68 +93,84 @@ class DealCandianTireScraper:
         result = self.get_product_response(url)
         
         if result != None:
-            
+            codes = []
             for product_info in result.get("products", []):
                 try:
                     orig_id = product_info["code"]
-                    is_exist = self.change_old2new_inlist(orig_id)
-                    
-                    if is_exist:
-                        pass
-                    else:
-                        try:
-                            product = Product.objects.get(site = self.site, orig_id=orig_id)
-                            self.all_deals.append(product)
-                        except Product.DoesNotExist:
-                            pass
+                    if not self.change_old2new_inlist(orig_id):
+                        codes.append(orig_id)
                 except Exception as e:
                     print (e)
                     continue
+
+            # one query for every new code on the page
+            found = Product.objects.filter(site = self.site, orig_id__in = codes).only(*DEAL_PRODUCT_FIELDS)
+            for product in found:
+                self.all_deals[product.orig_id] = product
+            for orig_id in codes:
+                if not self.change_old2new_inlist(orig_id):
+                    self.unknown_codes.append(orig_id)
             return result["pagination"]["total"]
         else:
             return None
         
     def get_price_response(self, sku_params, max_retries = 5, delay = 2):
-        retries = 0
-        while retries < max_retries:
-            try:
-                resp = requests.post(
-                    f"{self.settings['apiroot']}{API_GET_PRICE}", 
-                    headers = {
-                        "Ocp-Apim-Subscription-Key" : self.settings["apikey"],
-                        "Basesiteid": self.settings["id"],
-                        "Bannerid": self.settings["id"],
-                        "User-Agent": USER_AGENT
-                    },
-                    params = {
-                        "cache": "true",
-                        "lang": LANG,
-                        "storeId": self.settings["store"]
-                    },
-                    json= { "skus":sku_params },
-                    timeout = API_TIMEOUT
-                )
-                if resp.status_code == 200:
-                    return resp.json()
-            except requests.exceptions.RequestException as e:
-                print(f"Request failed: {e}")
-            retries += 1
-            print(f"PRICE:Retrying... ({retries}/{max_retries})")
-            time.sleep(delay)
-        print("Max retries reached. Could not get a successful response.")
-        return None
+        resp = throttled_request(
+            self.session,
+            "POST",
+            f"{self.settings['apiroot']}{API_GET_PRICE}", 
+            label = "PRICE:",
+            max_retries = max_retries,
+            delay = delay,
+            max_concurrency = self.settings.get("concurrency", DEFAULT_CONCURRENCY),
+            rate = self.settings.get("rate_limit", DEFAULT_RATE),
+            headers = {
+                "Ocp-Apim-Subscription-Key" : self.settings["apikey"],
+                "Basesiteid": self.settings["id"],
+                "Bannerid": self.settings["id"],
+                "User-Agent": USER_AGENT
+            },
+            params = {
+                "cache": "true",
+                "lang": LANG,
+                "storeId": self.settings["store"]
+            },
+            json= { "skus":sku_params },
+            timeout = API_TIMEOUT,
+            ok_statuses = (200,) + REJECTED_STATUSES
+        )
+        if resp is None:
+            return None
+        if resp.status_code in REJECTED_STATUSES:
+            raise BatchRejected(resp.status_code)
+        return resp.json()
 
-    def update_price(self, pre_info):
+    def get_product_prices(self, pre_info, price_index):
+        # the records of this product out of a batched lookup, or its own request when the batch missed any SKU
         skus = pre_info.skus.split(",")
+        if all(sku in price_index for sku in skus):
+            return {"skus": [price_index[sku] for sku in skus]}
         sku_params = []
         for sku in skus:
             sku_params.append({"code": str(sku), "lowStockThreshold": "0"})
+        print(f"Retrying price alone for : {pre_info.orig_id}")
+        try:
+            return self.get_price_response(sku_params=sku_params)
+        except BatchRejected as e:
+            print(f"PRICE: rejected with status {e} for : {pre_info.orig_id}")
+            return None
 
-        
-        result = self.get_price_response(sku_params=sku_params)
+    def update_price(self, pre_info, price_index, deal_batch):
+        # applies the new prices and queues them in deal_batch, returns the product's slot in the batch or None;
+        # is_deal is decided once the whole batch is evaluated
+        result = self.get_product_prices(pre_info, price_index)
         if result != None:
             try:
+                self.tracker.track(pre_info)
+                self.history.track(pre_info)
                 prods = result["skus"]
+                threshold = self.deal_thresholds.get(pre_info.category_id, self.settings.get("deal_threshold", DEAL_THRESHOLD))
+                index = deal_batch.add_product(threshold)
                 if pre_info.is_variant:
                     try:
                         old_variants = json.loads(pre_info.variants.replace("'", '"'))
@@ -160,107 +179,27 @@ class DealCandianTireScraper:
                         
                     new_variants = []
                     
-                    discount = 0
-                    new_discount = 0
-                    
                     for sku_value in prods:
                         for variant in old_variants:
                             if variant["sku"] == sku_value["code"]:
-                                if "originalPrice" in sku_value and sku_value["originalPrice"] is not None and "value" in sku_value["originalPrice"] and sku_value["originalPrice"]["value"] is not None:
-                                    variant["regular_price"] = sku_value["originalPrice"]["value"]
-                                else:
-                                    variant["regular_price"] = 0
-                                if "currentPrice" in sku_value and "value" in sku_value["currentPrice"] and sku_value["currentPrice"]["value"] is not None:
-                                    variant["sale_price"] = sku_value["currentPrice"]["value"]
-                                else:
-                                    variant["sale_price"] = 0
-                                if "fulfillment" in sku_value and "availability" in sku_value["fulfillment"] and "Corporate" in sku_value["fulfillment"]["availability"] and "Quantity" in sku_value["fulfillment"]["availability"]["Corporate"]:
-                                    variant["stock"] = sku_value["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                                elif "fulfillment" in sku_value and "availability" in sku_value["fulfillment"] and "quantity" in sku_value["fulfillment"]["availability"]:
-                                    variant["stock"] = sku_value["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                                else:
-                                    variant["stock"] = 0   
-                                
-                                if variant['regular_price'] > 0 and variant['sale_price'] > 0:
-                                    if variant['regular_price'] > variant['sale_price']:
-                                        new_discount = (variant['regular_price'] - variant['sale_price']) / variant['regular_price'] * 100
-                                else:
-                                    new_discount = 0
-                                    
-                                try:
-                                    if "Discount Applied" in sku_value["priceMessage"][0]["label"] if sku_value["priceMessage"][0]["label"] ==  None else "":
-                                        pattern = r'(\d+)%'
-                                        match = re.search(pattern, sku_value["priceMessage"][0]["label"] if sku_value["priceMessage"][0]["label"] ==  None else "" )
-                                        if match:
-                                            new_discount = int(match.group(1))
-                                except:
-                                    pass
-                                        
-                                if new_discount > discount:
-                                    discount = new_discount
-                                    
+                                variant["regular_price"], variant["sale_price"], variant["stock"] = parse_price_record(sku_value)
+                                deal_batch.add_price(index, variant["regular_price"], variant["sale_price"])
                                 new_variants.append(variant)
-                    self.product_count +=1
-                    
-                    if discount >= 30:
-                        print(f"*** {pre_info.orig_id} 30% off. : Discount : {discount} : Count : {self.product_count}")
-                        pre_info.variants = json.dumps(new_variants)
-                        pre_info.is_deal = True
-                    else:
-                        pre_info.variants = json.dumps(new_variants)
-                        pre_info.is_deal = False
-                        print(f"--- No Deal : {pre_info.orig_id} : Discount : {discount} : Count : {self.product_count}")
-                    self.temp_products_update.append(pre_info)
+                    pre_info.variants = json.dumps(new_variants)
                 else:
-                    sku_value = prods[0]
-                    if "originalPrice" in sku_value and sku_value["originalPrice"] is not None and "value" in sku_value["originalPrice"] and sku_value["originalPrice"]["value"] is not None:
-                        regular_price = sku_value["originalPrice"]["value"]
-                    else:
-                        regular_price = 0
-                    if "currentPrice" in sku_value and "value" in sku_value["currentPrice"] and sku_value["currentPrice"]["value"] is not None:
-                        sale_price = sku_value["currentPrice"]["value"]
-                    else:
-                        sale_price = 0
-                    if "fulfillment" in sku_value and "availability" in sku_value["fulfillment"] and "Corporate" in sku_value["fulfillment"]["availability"] and "Quantity" in sku_value["fulfillment"]["availability"]["Corporate"]:
-                        stock = sku_value["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                    elif "fulfillment" in sku_value and "availability" in sku_value["fulfillment"] and "quantity" in sku_value["fulfillment"]["availability"]:
-                        stock = sku_value["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                    else:
-                        stock = 0
-
-                    if regular_price > 0 and sale_price > 0:
-                        if regular_price > sale_price: 
-                            discount = (regular_price - sale_price) / regular_price * 100
-                    else:       
-                        discount = 0
-                    try:
-                        if "Discount Applied" in sku_value["priceMessage"][0]["label"] if sku_value["priceMessage"][0]["label"] ==  None else "":
-                            pattern = r'(\d+)%'
-                            match = re.search(pattern, sku_value["priceMessage"][0]["label"] if sku_value["priceMessage"][0]["label"] ==  None else "")
-                            if match:
-                                discount = int(match.group(1))
-                    except:
-                        pass
-                    self.product_count +=1
-                    if discount >= 30:
-                        print(f"*** Deal : {pre_info.orig_id} 30% off : Discount : {discount} : Count : {self.product_count}")
-                        pre_info.regular_price = regular_price
-                        pre_info.sale_price = sale_price
-                        pre_info.stock = stock
-                        pre_info.is_deal = True
-                    else:
-                        pre_info.regular_price = regular_price
-                        pre_info.sale_price = sale_price
-                        pre_info.stock = stock
-                        pre_info.is_deal = False
-                        print(f"--- No Deal : {pre_info.orig_id} : Discount : {discount} : Count : {self.product_count}")
-                    self.temp_products_update.append(pre_info)
-                return True
+                    pre_info.regular_price, pre_info.sale_price, pre_info.stock = parse_price_record(prods[0])
+                    deal_batch.add_price(index, pre_info.regular_price, pre_info.sale_price)
+                return index
             except:
-                return False
+                return None
         else:
-            return False
+            return None
         
+    def flush_deals(self):
+        changed = self.tracker.flush(Product)
+        recorded = self.history.flush(changed)
+        print(f"Bulk Update Deals : {len(changed)} changed, {len(recorded)} price history rows")
+
     def start(self):
         print("Starting Deal products...")
 
@@ -271,6 +210,7 @@ class DealCandianTireScraper:
             print("Reversing Old deals to init...")
 
             self.reverse_old_deals()
+            self.deal_thresholds = load_deal_thresholds(self.site, self.settings.get("deal_threshold", DEAL_THRESHOLD))
 
             page = 1
             
@@ -287,22 +227,41 @@ class DealCandianTireScraper:
 
             print("Update Price for All Deals")
 
-            for index, item in enumerate(self.all_deals, start=1):
-                if item.is_deal:
-                    print(f"+++ Update Price For Old Deal : {item.orig_id}")
-                    success = self.update_price(item)
-                    if success == False:
-                        print(f"Failed : Update Price For New Deal : {item.orig_id}")
-                else:
-                    print(f"--- Update Price For New Deal : {item.orig_id}")
-                    success = self.update_price(item)
-                    if success == False:
-                        print(f"Failed : Update Price For New Deal : {item.orig_id}")
-                
-                if index % 100 == 0:
-                    print(f"Bulk Update Deals")
-                    Product.objects.bulk_update(self.temp_products_update, ['sale_price', 'regular_price', 'stock', 'is_deal', 'variants'])
-                    self.temp_products_update.clear()
-                    
+            # the SKUs of a whole batch of deals go through the pipelined PriceAvailability batches at once
+            deals = list(self.all_deals.values())
+            for start in range(0, len(deals), DEAL_BATCH_SIZE):
+                batch = deals[start:start + DEAL_BATCH_SIZE]
+                batch_skus = []
+                for item in batch:
+                    batch_skus.extend(item.skus.split(","))
+                price_index = self.price_fetcher.fetch(batch_skus)
+
+                deal_batch = DealBatch()
+                evaluated = []
+                for item in batch:
+                    if item.is_deal:
+                        print(f"+++ Update Price For Old Deal : {item.orig_id}")
+                    else:
+                        print(f"--- Update Price For New Deal : {item.orig_id}")
+                    index = self.update_price(item, price_index, deal_batch)
+                    if index is None:
+                        print(f"Failed : Update Price For Deal : {item.orig_id}")
+                    else:
+                        evaluated.append((item, index))
+
+                discounts, is_deals = deal_batch.evaluate()
+                for item, index in evaluated:
+                    self.product_count += 1
+                    item.is_deal = bool(is_deals[index])
+                    if item.is_deal:
+                        print(f"*** Deal : {item.orig_id} {deal_batch.thresholds[index]:g}% off : Discount : {discounts[index]:.1f} : Count : {self.product_count}")
+                    else:
+                        print(f"--- No Deal : {item.orig_id} : Discount : {discounts[index]:.1f} : Count : {self.product_count}")
+
+                self.flush_deals()
+            if len(self.unknown_codes) > 0:
+                print(f"Unknown products on deal pages : {len(self.unknown_codes)} : {', '.join(self.unknown_codes)}")
             print(f"Updated Deals for site : {self.settings['domain']}")
-            self.product_count = 0
\ No newline at end of file
+            self.product_count = 0
+            self.all_deals = {}
+            self.unknown_codes = []
\ No newline at end of file
@@ -0,0 +1,78 @@
+import numpy as np
+from scraper.models import Category
+
+DEAL_THRESHOLD = 30
+
+def parse_price_record(record):
+    # (regular_price, sale_price, stock) out of one PriceAvailability record, 0 for anything the API left out
+    original = record.get("originalPrice") or {}
+    current = record.get("currentPrice") or {}
+    availability = (record.get("fulfillment") or {}).get("availability") or {}
+    corporate = availability.get("Corporate") or {}
+    regular_price = original.get("value") or 0
+    sale_price = current.get("value") or 0
+    if "Quantity" in corporate:
+        stock = corporate["Quantity"]
+    elif "quantity" in availability:
+        stock = availability["quantity"]
+    else:
+        stock = 0
+    return regular_price, sale_price, stock
+
+def load_deal_thresholds(site, default = DEAL_THRESHOLD):
+    # category id -> threshold, a category without its own threshold takes the nearest ancestor's or the site's
+    categories = {category.id: category for category in Category.objects.filter(site=site).only("id", "parent_id", "deal_threshold")}
+    thresholds = {}
+    def resolve(category_id):
+        if category_id not in thresholds:
+            category = categories[category_id]
+            if category.deal_threshold is not None:
+                thresholds[category_id] = category.deal_threshold
+            elif category.parent_id in categories:
+                thresholds[category_id] = resolve(category.parent_id)
+            else:
+                thresholds[category_id] = default
+        return thresholds[category_id]
+    for category_id in categories:
+        resolve(category_id)
+    return thresholds
+
+def evaluate_deals(regular, sale, counts, thresholds):
+    # regular and sale hold the SKU prices of every product back to back, counts[i] of them for product i;
+    # returns the best discount of each product in percent and whether it reaches the product's threshold
+    regular = np.fromiter(regular, dtype=np.float64, count=len(regular))
+    sale = np.fromiter(sale, dtype=np.float64, count=len(sale))
+    counts = np.fromiter(counts, dtype=np.int64, count=len(counts))
+    thresholds = np.fromiter(thresholds, dtype=np.float64, count=len(thresholds))
+    best = np.zeros(len(thresholds))
+    if len(regular) > 0:
+        valid = (regular > 0) & (sale > 0) & (regular > sale)
+        discounts = np.zeros(len(regular))
+        np.divide((regular - sale) * 100, regular, out=discounts, where=valid)
+        # one segment per product, a product without prices keeps 0
+        starts = np.cumsum(counts) - counts
+        priced = counts > 0
+        best[priced] = np.maximum.reduceat(discounts, starts[priced])
+    return best, best >= thresholds
+
+class DealBatch:
+    # collects the prices of many products so their discounts are worked out in one evaluate_deals call,
+    # the prices of a product have to be added before the next product
+    def __init__(self):
+        self.regular = []
+        self.sale = []
+        self.counts = []
+        self.thresholds = []
+
+    def add_product(self, threshold):
+        self.counts.append(0)
+        self.thresholds.append(threshold)
+        return len(self.thresholds) - 1
+
+    def add_price(self, index, regular_price, sale_price):
+        self.regular.append(regular_price)
+        self.sale.append(sale_price)
+        self.counts[index] += 1
+
+    def evaluate(self):
+        return evaluate_deals(self.regular, self.sale, self.counts, self.thresholds)
@@ -0,0 +1,135 @@
+import json
+from lxml import etree, html
+from lxml.cssselect import CSSSelector
+from lxml.html import tostring
+
+# runs in the parser processes, so nothing here may touch Django or the scraper's state
+
+# compiled once at import, each page only runs the ready XPath
+MAGENTO_INIT_SCRIPTS = etree.XPath('//script[@type="text/x-magento-init"]/text()')
+PRODUCT_INFO_MAIN = CSSSelector('#maincontent div.columns div.main div.product-info-main')
+PRODUCT_INFO_PRICE = CSSSelector('div.product-info-price')
+OLD_PRICE = CSSSelector('span.old-price')
+PRICE_CONTAINER = CSSSelector('span.price-container')
+OLD_PRICE_WRAPPER = CSSSelector('div.price-box span.old-price span.price-container span.price-wrapper')
+DESCRIPTION = etree.XPath('//div[@id="product.info.description"]')
+MARKETING_TEXT = CSSSelector('div.marketing_text')
+GALLERY_KEY = '[data-gallery-role=gallery-placeholder]'
+
+def first(nodes):
+    return nodes[0] if len(nodes) > 0 else None
+
+def get_images(scripts):
+    images = []
+    for script in scripts:
+        script = script.strip()
+        if 'mage/gallery/gallery' in script:
+            gallery_data = json.loads(script)
+            for data_image in gallery_data[GALLERY_KEY]['mage/gallery/gallery']['data']:
+                images.append(data_image['img'])
+    return images
+
+def get_regular_price(product_info_main):
+    price_info = first(PRODUCT_INFO_PRICE(product_info_main))
+    if price_info is None:
+        return 0
+    old_price = first(OLD_PRICE(price_info))
+    if old_price is None or len(PRICE_CONTAINER(old_price)) == 0:
+        return 0
+    price_wrapper = first(OLD_PRICE_WRAPPER(price_info))
+    if price_wrapper is None:
+        return 0
+    return price_wrapper.text_content().strip().replace("$", "").replace(",", "")
+
+def get_description(description_div):
+    if description_div is None:
+        return ""
+    marketing_text = first(MARKETING_TEXT(description_div))
+    if marketing_text is None:
+        return ""
+    return tostring(marketing_text).decode('utf-8')
+
+def has_class(element, tag, name):
+    return element.tag == tag and name in element.get("class", "").split()
+
+def is_product_info_main(element):
+    # the nesting PRODUCT_INFO_MAIN selects, checked on the ancestors that are already open while streaming
+    if not has_class(element, "div", "product-info-main"):
+        return False
+    wanted = [
+        lambda ancestor: has_class(ancestor, "div", "main"),
+        lambda ancestor: has_class(ancestor, "div", "columns"),
+        lambda ancestor: ancestor.get("id") == "maincontent",
+    ]
+    for ancestor in element.iterancestors():
+        if wanted[0](ancestor):
+            wanted.pop(0)
+            if len(wanted) == 0:
+                return True
+    return False
+
+def get_block(element):
+    if element.tag == "script" and element.get("type") == "text/x-magento-init":
+        return "script"
+    if element.tag == "div" and element.get("id") == "product.info.description":
+        return "description"
+    if is_product_info_main(element):
+        return "main"
+    return None
+
+def stream_product_page(chunks, encoding = None):
+    # same result as parse_product_page from the page fed chunk by chunk: everything outside the blocks we read
+    # is dropped as soon as it is closed, and reading stops once the price, the description and the gallery are in
+    parser = etree.HTMLPullParser(events=("start", "end"), tag=("div", "script"), encoding=encoding)
+    # HtmlElement, for text_content() like the full parse
+    parser.set_element_class_lookup(html.HtmlElementClassLookup())
+    open_blocks = 0
+    found = set()
+    regular_price = 0
+    description = ""
+    images = []
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            block = get_block(element)
+            if event == "start":
+                if block is not None:
+                    open_blocks += 1
+                continue
+            if block is None:
+                if open_blocks == 0:
+                    element.clear(keep_tail=True)
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+                continue
+            open_blocks -= 1
+            if block == "main":
+                regular_price = get_regular_price(element)
+                found.add("main")
+            elif block == "description":
+                description = get_description(element)
+                found.add("description")
+            elif element.text is not None and 'mage/gallery/gallery' in element.text:
+                images.extend(get_images([element.text]))
+                found.add("gallery")
+        if len(found) == 3:
+            break
+    if "main" not in found:
+        return None
+    return {
+        "regular_price": regular_price,
+        "description": description,
+        "images": images,
+    }
+
+def parse_product_page(text):
+    # regular_price, description and images of a product page, or None when the page is not a product
+    html_tree = html.fromstring(text)
+    product_info_main = first(PRODUCT_INFO_MAIN(html_tree))
+    if product_info_main is None:
+        return None
+    return {
+        "regular_price": get_regular_price(product_info_main),
+        "description": get_description(first(DESCRIPTION(html_tree))),
+        "images": get_images(MAGENTO_INIT_SCRIPTS(html_tree)),
+    }
@@ -2,10 +2,21 @@ import requests
 import json
 from scraper.models import Website, Category, Product
 from lxml import html
-from lxml.html import tostring
 import math
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from .category_tree import sync_category_tree
+from .throttle import throttled_request, DEFAULT_CONCURRENCY, DEFAULT_RATE
+from .kms_parser import parse_product_page, stream_product_page
+from .bulk import DirtyTracker
+from .price_history import PriceHistoryRecorder
 
 API_TIMEOUT = 100000
+STREAM_CHUNK_SIZE = 16 * 1024
+REFRESH_FIELDS = ['sale_price', 'stock']
+# what the price history reads besides the refreshed fields
+HISTORY_FIELDS = ['skus', 'is_variant', 'regular_price']
 
 class KmstoolsScraper:
     def __init__(self) -> None:
@@ -14,9 +25,16 @@ class KmstoolsScraper:
         self.session            = requests.session()
         self.category_count     = 0
         self.product_count      = 0
-        self.html_tree          = None
         self.categories         = []
         self.category_filters   = []
+        self.existing_ids       = set()
+        self.existing_products  = {}
+        self.tracker            = DirtyTracker(REFRESH_FIELDS)
+        self.history            = PriceHistoryRecorder()
+        self.new_count          = 0
+        self.category_ids       = {}
+        self.fetch_executor     = None
+        self.parse_executor     = None
 
     def set_settings(self, settings):
         for key in ["name", "domain", "url", "label"]:
@@ -26,6 +44,18 @@ class KmstoolsScraper:
         self.settings = settings
         return True
 
+    def get(self, url, label = "", **kwargs):
+        return throttled_request(
+            self.session,
+            "GET",
+            url,
+            label = label,
+            max_concurrency = self.settings.get("concurrency", DEFAULT_CONCURRENCY),
+            rate = self.settings.get("rate_limit", DEFAULT_RATE),
+            timeout = API_TIMEOUT,
+            **kwargs
+        )
+
     def create_site(self, name, domain, url):
         try:
             site = Website.objects.get(name=name)
@@ -36,47 +66,35 @@ class KmstoolsScraper:
         except Exception as e:
             raise e
 
-    def create_category(self, site, cat_info, level, parent = None, parent_paths = []):
+    def collect_category(self, site, cat_info, level, nodes, parent = None, parent_paths = []):
         cat_paths = parent_paths.copy()
         cat_paths.append(cat_info["name"])
         orig_id = cat_info["name"].replace(' ', '') + "_" + str(level) + "_" + str(site.id)
-        try:
-            category = Category.objects.get(site=site, orig_id=orig_id)
-            self.category_count += 1
-            category.orig_path = " > ".join(cat_paths)
-            category.save()
-            print("-" * level, f"{self.category_count} : {category.name}: {cat_paths}")
-        except Category.DoesNotExist:
-            role = "leaf"
-            if cat_info["sub_categories"] and len(cat_info["sub_categories"]) > 0:
-                role ="node"
-            category = Category.objects.create(
-                site = site, 
-                name = cat_info["name"],
-                url = cat_info["url"],
-                role = role,
-                level = level,
-                orig_id = orig_id,
-                parent = parent,
-                orig_path = " > ".join(cat_paths)
-            )
-            self.category_count += 1
-            print("+" * level, f"{self.category_count} : {category.name}: {cat_paths}")
-        except Exception as e:
-            raise e
+        role = "leaf"
+        if cat_info["sub_categories"] and len(cat_info["sub_categories"]) > 0:
+            role ="node"
+        nodes.append({
+            "orig_id": orig_id,
+            "parent": parent,
+            "name": cat_info["name"],
+            "url": cat_info["url"],
+            "role": role,
+            "level": level,
+            "orig_path": " > ".join(cat_paths),
+        })
+        self.category_count += 1
         if level > 1:
             self.category_filters.append(cat_paths)
         for subcat in cat_info["sub_categories"]:
-            self.create_category(site, subcat, level + 1, category, cat_paths)
+            self.collect_category(site, subcat, level + 1, nodes, orig_id, cat_paths)
 
     def create_categories_for_site(self, site):
         print("make categories ...")
-        resp = self.session.get(
-            self.settings["url"],
-            timeout = API_TIMEOUT
-        )
-        self.html_tree = html.fromstring(resp.text)
-        li_cateory_parents = self.html_tree.cssselect('ul#navpro-topnav')[0].cssselect('div.navpro-dropdown.navpro-dropdown-level1.size-small')[0].cssselect('ul.children')[0].cssselect('li.parent')
+        resp = self.get(self.settings["url"], "HOME:")
+        if resp is None:
+            return
+        html_tree = html.fromstring(resp.text)
+        li_cateory_parents = html_tree.cssselect('ul#navpro-topnav')[0].cssselect('div.navpro-dropdown.navpro-dropdown-level1.size-small')[0].cssselect('ul.children')[0].cssselect('li.parent')
         for li_cateory_parent in li_cateory_parents:
             name = li_cateory_parent.cssselect('a')[0].cssselect('span')[0].text_content().strip()
             url = li_cateory_parent.cssselect('a')[0].get('href')
@@ -95,115 +113,197 @@ class KmstoolsScraper:
                 'url' : url,
                 'sub_categories' : sub_categories
             })
+        nodes = []
         for category in self.categories:
-            self.create_category(site, category, 1)
+            self.collect_category(site, category, 1, nodes)
+        sync_category_tree(site, nodes)
     
+    def is_refresh(self):
+        return self.settings.get("mode") == "refresh"
+
+    def load_category_filters(self, site):
+        # the searchspring filters of the stored tree, for a refresh that does not read the home page
+        for category in Category.objects.filter(site=site, level__gt=1).order_by('id'):
+            self.category_filters.append(category.orig_path.split(" > "))
+
     def create_products_for_site(self, site):
         print("make products ...")
+        # everything the per-product checks need, loaded once for the run
+        existing = Product.objects.filter(site=site).only("id", "orig_id", *REFRESH_FIELDS, *HISTORY_FIELDS)
+        self.existing_products = {product.orig_id: product for product in existing}
+        self.existing_ids = set(self.existing_products)
+        self.category_ids = dict(Category.objects.filter(site=site).values_list("orig_path", "id"))
         for cat_path in self.category_filters:
             cat_url = f"{self.api_url}resultsFormat=native&siteId=skg4w4&bgfilter.category_hierarchy={'>'.join(cat_path)}"
-            resp = self.session.get(
-                cat_url,
-                timeout = API_TIMEOUT
-            )
+            resp = self.get(cat_url, "SEARCH:")
+            if resp is None:
+                continue
             result = resp.json()
             totalPages = result['pagination']['totalPages']
             if totalPages > 0:
                 for page in range(1, totalPages+1):
                     products_url = f"{cat_url}&page={page}"
-                    resp = self.session.get(
-                        products_url,
-                        timeout = API_TIMEOUT
-                    )
+                    resp = self.get(products_url, "SEARCH:")
+                    if resp is None:
+                        continue
                     result = resp.json()
                     products = result['results']
+                    new_products = []
                     for product in products:
-                        self.create_product_one_by_one(site, cat_path, product)
+                        new_product = self.prepare_product(site, cat_path, product)
+                        if new_product is not None:
+                            new_products.append(new_product)
+                    created = self.create_products(new_products)
+                    changed = self.tracker.flush(Product)
+                    recorded = self.history.flush(changed + created)
+                    print(f"Refreshed from search : {len(changed)} of {len(products)} products changed, {len(recorded)} price history rows")
+        if self.new_count > 0:
+            print(f"New products left for a full scrape : {self.new_count}")
 
-    def create_product_one_by_one(self, site, cat_path, product_info):
-        orig_path = ' > '.join(cat_path)
-        try:
-            category = Category.objects.get(site=site, orig_path=orig_path)
-            category_id = category.id
-        except :
-            print("Unregistered Category : ", orig_path)
-            return
-            
-        url = f"{self.settings['url']}{product_info['url']}"
-        print(url)
-        orig_id = product_info["id"]
-        sku = product_info["sku"]
-        name = product_info["name"]
-        sale_price = product_info["final_price"]
+    def get_search_fields(self, product_info):
+        # sale price and stock as the search result gives them
+        sale_price = float(product_info["final_price"])
         stock = 0
         if 'stock_qty' in product_info :
             stock = math.floor(float(product_info["stock_qty"]))
         if stock == -1 :
             stock = 0
+        return sale_price, stock
+
+    def refresh_product(self, orig_id, sale_price, stock):
+        product = self.existing_products.get(orig_id)
+        if product is None:
+            return
+        self.tracker.track(product)
+        self.history.track(product)
+        product.sale_price = sale_price
+        product.stock = stock
+
+    def prepare_product(self, site, cat_path, product_info):
+        # a new product with the fields of its search result, None when it is already stored or its category is not;
+        # a stored product gets its price and stock from the search result, without fetching its page
+        url = f"{self.settings['url']}{product_info['url']}"
+        print(url)
+        orig_id = str(product_info["id"])
+        sku = product_info["sku"]
+        name = product_info["name"]
+        sale_price, stock = self.get_search_fields(product_info)
         brand = ""
         if 'brand' in product_info :
             brand = product_info["brand"] 
 
+        if orig_id in self.existing_ids:
+            self.refresh_product(orig_id, sale_price, stock)
+            self.product_count += 1
+            print(f"--- PRODUCT {self.product_count} : {name}")
+            return None
+        if self.is_refresh():
+            self.new_count += 1
+            return None
 
+        orig_path = ' > '.join(cat_path)
+        category_id = self.category_ids.get(orig_path)
+        if category_id is None:
+            print("Unregistered Category : ", orig_path)
+            return None
+        # claimed now so the same product listed under another category is not fetched twice
+        self.existing_ids.add(orig_id)
+        return Product(
+            site = site, 
+            category_id = category_id,
+            name = name,
+            brand = brand,
+            url = url,
+            specification = "",
+            features = "",
+            orig_id = orig_id,
+            skus = json.dumps([sku]),
+            status = "off",
+            stock = stock,
+            sale_price = sale_price,
+        )
+
+    def fetch_page(self, url):
+        resp = self.get(url, "PRODUCT:")
+        if resp is None:
+            return None
+        return resp.text
+
+    def stream_page(self, url):
+        # parsed while it downloads, the rest of the page is not read once the blocks we need went by
+        resp = self.get(url, "PRODUCT:", stream=True)
+        if resp is None:
+            return None
         try:
-            product = Product.objects.get(name=name)
-            self.product_count += 1
-            print(f"--- PRODUCT {self.product_count} : {product.name}")
-        except Product.DoesNotExist:
-            resp = self.session.get(
-                url,
-                timeout = API_TIMEOUT
-            )
-
-            html_content = resp.text.replace('product.info.description', 'product-info-description')
-            self.html_tree = html.fromstring(html_content)
-            regular_price = 0
-            description = ""
-            images = []
-            scripts = self.html_tree.xpath('//script[@type="text/x-magento-init"]/text()')
-            for script in scripts:
-                if 'mage/gallery/gallery' in script.strip():
-                    gallery_data = json.loads(script.strip())
-                    data_images = gallery_data['[data-gallery-role=gallery-placeholder]']['mage/gallery/gallery']['data'] 
-                    for data_image in data_images:
-                        images.append(data_image['img'])
+            return stream_product_page(resp.iter_content(chunk_size=STREAM_CHUNK_SIZE), resp.encoding)
+        finally:
+            resp.close()
+
+    def create_products(self, products):
+        # pages are fetched by the thread pool and handed to the parser processes as they arrive, or in stream
+        # mode parsed by the fetching thread itself; the products that parsed are written with one bulk insert
+        # and returned
+        parses = {}
+        if self.settings.get("parse_mode", "tree") == "stream":
+            parses = {self.fetch_executor.submit(self.stream_page, product.url): product for product in products}
+        else:
+            fetches = {self.fetch_executor.submit(self.fetch_page, product.url): product for product in products}
+            for future in as_completed(fetches):
+                product = fetches[future]
+                text = future.result()
+                if text is None:
+                    self.existing_ids.discard(product.orig_id)
+                    continue
+                parses[self.parse_executor.submit(parse_product_page, text)] = product
+
+        new_products = []
+        for future in as_completed(parses):
+            product = parses[future]
             try:
-                if not self.html_tree.cssselect('#maincontent')[0].cssselect('div.columns')[0].cssselect('div.main')[0].cssselect('div.product-info-main'):
-                    print("------ 404")
-                    return
-            except:
-                return
-            if self.html_tree.cssselect('#maincontent')[0].cssselect('div.columns')[0].cssselect('div.main')[0].cssselect('div.product-info-main')[0].cssselect('div.product-info-price')[0].cssselect('span.old-price') and len(self.html_tree.cssselect('#maincontent')[0].cssselect('div.columns')[0].cssselect('div.main')[0].cssselect('div.product-info-main')[0].cssselect('div.product-info-price')[0].cssselect('span.old-price')[0].cssselect('span.price-container')) > 0:
-                regular_price = self.html_tree.cssselect('#maincontent')[0].cssselect('div.columns')[0].cssselect('div.main')[0].cssselect('div.product-info-main')[0].cssselect('div.product-info-price')[0].cssselect('div.price-box')[0].cssselect('span.old-price')[0].cssselect('span.price-container')[0].cssselect('span.price-wrapper')[0].text_content().strip().replace("$", "").replace(",", "")
-
-            if self.html_tree.cssselect('div#product-info-description'):
-                div_description = self.html_tree.cssselect('div#product-info-description')[0].cssselect('div.marketing_text')[0]
-                description = tostring(div_description).decode('utf-8')
-            product = Product.objects.create(
-                site = site, 
-                category_id = category_id,
-                name = name,
-                brand = brand,
-                url = url,
-                description = description,
-                specification = "",
-                features = "",
-                images = json.dumps(images),
-                orig_id = orig_id,
-                skus = json.dumps([sku]),
-                status = "off",
-                stock = stock,
-                sale_price = sale_price,
-                regular_price = regular_price,
-            )
+                page = future.result()
+            except Exception as e:
+                print(f"Failed to parse {product.url} : {e}")
+                page = None
+            if page is None:
+                print("------ 404")
+                self.existing_ids.discard(product.orig_id)
+                continue
+            product.regular_price = page["regular_price"]
+            product.description = page["description"]
+            product.images = json.dumps(page["images"])
+            new_products.append(product)
+
+        if len(new_products) > 0:
+            Product.objects.bulk_create(new_products, batch_size=100, ignore_conflicts=True)
+            # ignore_conflicts never hands back the ids, the price history needs them
+            ids = dict(Product.objects.filter(site=new_products[0].site, orig_id__in=[product.orig_id for product in new_products]).values_list("orig_id", "id"))
+            for product in new_products:
+                product.id = ids.get(product.orig_id)
+        for product in new_products:
             self.product_count += 1
             print(f"+++ PRODUCT {self.product_count} : {product.name}")
+        return new_products
 
     def start(self):
         print("start to scrape ...")
         if self.settings is None:
             print(f"settings should be setted, first.")
             return
-        site = self.create_site(self.settings["name"], self.settings["domain"], self.settings["url"]) 
-        self.create_categories_for_site(site)
-        self.create_products_for_site(site)
+        concurrency = self.settings.get("concurrency", DEFAULT_CONCURRENCY)
+        self.session.mount("https://", HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency))
+        # lxml holds the GIL while it parses, so the pages are parsed in separate processes; spawn keeps the
+        # parent's threads and database connection out of them
+        self.fetch_executor = ThreadPoolExecutor(max_workers=concurrency)
+        if self.settings.get("parse_mode", "tree") != "stream" and not self.is_refresh():
+            self.parse_executor = ProcessPoolExecutor(max_workers=self.settings.get("workers"), mp_context=multiprocessing.get_context("spawn"))
+        try:
+            site = self.create_site(self.settings["name"], self.settings["domain"], self.settings["url"]) 
+            if self.is_refresh():
+                self.load_category_filters(site)
+            else:
+                self.create_categories_for_site(site)
+            self.create_products_for_site(site)
+        finally:
+            self.fetch_executor.shutdown()
+            if self.parse_executor is not None:
+                self.parse_executor.shutdown()
@@ -0,0 +1,101 @@
+import math
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+PIPELINE_DEPTH = 4
+START_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 500
+# accepted batches after a rejection before a batch above the rejected size is tried again
+CEILING_RETRY = 50
+# statuses the API refuses a batch with, for its size or for a SKU in it
+REJECTED_STATUSES = (400, 413, 414)
+
+class BatchRejected(Exception):
+    # raised by the post function when the API refused the batch itself rather than failing to answer
+    pass
+
+class PriceFetcher:
+    # resolves any number of SKUs through PriceAvailability with several batches in flight at once;
+    # the batch size grows while the API keeps answering and a rejected batch (BatchRejected) is split in half
+    # and retried down to the single SKU refused, so one bad SKU costs only its own price; a rejection bigger than
+    # any batch that went through also lowers the ceiling, which is lifted again after CEILING_RETRY accepted
+    # batches, so the fetcher settles on the largest batch the endpoint accepts; timeouts and server errors never
+    # split a batch
+    def __init__(self, post, depth = PIPELINE_DEPTH, batch_size = START_BATCH_SIZE, max_batch_size = MAX_BATCH_SIZE):
+        self.post = post
+        self.depth = depth
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        self.largest_ok = 0
+        self.smallest_failed = math.inf
+        self.since_failed = 0
+        self.unanswered = set()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=depth)
+
+    def post_batch(self, skus):
+        sku_params = []
+        for sku in skus:
+            sku_params.append({"code": sku, "lowStockThreshold": "0"})
+        return self.post(sku_params)
+
+    def grow(self, size):
+        with self.lock:
+            self.largest_ok = max(self.largest_ok, size)
+            self.since_failed += 1
+            if self.since_failed >= CEILING_RETRY:
+                self.smallest_failed = math.inf
+            if size >= self.batch_size:
+                ceiling = min(self.max_batch_size, self.smallest_failed - 1)
+                self.batch_size = min(ceiling, self.batch_size + max(1, self.batch_size // 4))
+
+    def shrink(self, size):
+        with self.lock:
+            self.smallest_failed = min(self.smallest_failed, size)
+            self.since_failed = 0
+            self.batch_size = max(1, min(self.batch_size, max(self.largest_ok, size // 2)))
+
+    def fetch(self, skus):
+        # returns {code: price record}, SKUs the API never answered for are left out; those whose batch got
+        # no answer at all (timeouts, server errors) are kept in unanswered until the next fetch
+        self.unanswered = set()
+        skus = list(dict.fromkeys(str(sku) for sku in skus))
+        price_map = {}
+        retries = deque()
+        position = 0
+        in_flight = {}
+        while position < len(skus) or len(retries) > 0 or len(in_flight) > 0:
+            while len(in_flight) < self.depth and (position < len(skus) or len(retries) > 0):
+                if len(retries) > 0:
+                    batch = retries.popleft()
+                else:
+                    batch = skus[position:position + self.batch_size]
+                    position += len(batch)
+                in_flight[self.executor.submit(self.post_batch, batch)] = batch
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = in_flight.pop(future)
+                rejected = False
+                try:
+                    result = future.result()
+                except BatchRejected:
+                    result = None
+                    rejected = True
+                if result is not None:
+                    for record in result.get("skus", []):
+                        price_map[str(record["code"])] = record
+                    self.grow(len(batch))
+                elif rejected and len(batch) > 1:
+                    # no bigger than a batch that went through, a SKU in it is refused rather than its size
+                    if len(batch) > self.largest_ok:
+                        self.shrink(len(batch))
+                    print(f"PRICE: batch of {len(batch)} rejected, retrying in halves, batches of {self.batch_size}")
+                    half = len(batch) // 2
+                    retries.append(batch[:half])
+                    retries.append(batch[half:])
+                else:
+                    if not rejected:
+                        self.unanswered.update(batch)
+                    print(f"PRICE: no price for {len(batch)} skus starting at {batch[0]}")
+        return price_map
@@ -1,8 +1,16 @@
 import requests
 import json
-from scraper.models import Website, Category, Product
+from scraper.models import Website, Category, Product, SweepCursor
 import threading
+import heapq
+import math
 import time
+from django.utils import timezone
+from .throttle import throttled_request, DEFAULT_CONCURRENCY, DEFAULT_RATE
+from .bulk import DirtyTracker
+from .price_api import PriceFetcher, BatchRejected, REJECTED_STATUSES
+from .price_history import PriceHistoryRecorder
+from .deals import parse_price_record
 
 LANG = "en_CA"
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36"
@@ -12,6 +20,16 @@ API_LOAD_PRODUCT = "/v1/search/search"
 API_GET_PRODUCT = "/v1/product/api/v1/product/productFamily"
 API_GET_PRICE = "/v1/product/api/v1/product/sku/PriceAvailability"
 API_TIMEOUT = 10000
+PRICE_UPDATE_FIELDS = ['sale_price', 'regular_price', 'stock', 'variants']
+SWEEP_WINDOW = 500
+REFRESH_BATCH = 500
+CANDIDATE_POOL = 5000
+MIN_RECHECK = 5 * 60
+CHANGE_RATE_ALPHA = 0.2
+CHANGE_RATE_WEIGHT = 20
+DEAL_WEIGHT = 4
+LOW_STOCK = 5
+LOW_STOCK_WEIGHT = 2
 
 class PriceCanadianTireScraper:
     def __init__(self) -> None:
@@ -19,6 +37,7 @@ class PriceCanadianTireScraper:
         self.session = requests.session()
         self.category_count = 0
         self.product_count = 0
+        self.price_fetcher = PriceFetcher(self.get_price_response)
         
     def set_settings(self, settings):
         for key in ["name", "domain", "url", "label", "id", "store", "apikey", "apiroot"]:
@@ -36,124 +55,173 @@ class PriceCanadianTireScraper:
             return False
 
     def get_price_response(self, sku_params, max_retries = 5, delay = 2):
-        retries = 0
-        while retries < max_retries:
-            try:
-                resp = requests.post(
-                    f"{self.settings['apiroot']}{API_GET_PRICE}", 
-                    headers = {
-                        "Ocp-Apim-Subscription-Key" : self.settings["apikey"],
-                        "Basesiteid": self.settings["id"],
-                        "Bannerid": self.settings["id"],
-                        "User-Agent": USER_AGENT
-                    },
-                    params = {
-                        "cache": "true",
-                        "lang": LANG,
-                        "storeId": self.settings["store"]
-                    },
-                    json= { "skus":sku_params },
-                    timeout = API_TIMEOUT
-                )
-                if resp.status_code == 200:
-                    return resp.json()
-            except requests.exceptions.RequestException as e:
-                print(f"Request failed: {e}")
-            retries += 1
-            print(f"PRICE:Retrying... ({retries}/{max_retries})")
-            time.sleep(delay)
-        print("Max retries reached. Could not get a successful response.")
-        return None
+        resp = throttled_request(
+            self.session,
+            "POST",
+            f"{self.settings['apiroot']}{API_GET_PRICE}", 
+            label = "PRICE:",
+            max_retries = max_retries,
+            delay = delay,
+            max_concurrency = self.settings.get("concurrency", DEFAULT_CONCURRENCY),
+            rate = self.settings.get("rate_limit", DEFAULT_RATE),
+            headers = {
+                "Ocp-Apim-Subscription-Key" : self.settings["apikey"],
+                "Basesiteid": self.settings["id"],
+                "Bannerid": self.settings["id"],
+                "User-Agent": USER_AGENT
+            },
+            params = {
+                "cache": "true",
+                "lang": LANG,
+                "storeId": self.settings["store"]
+            },
+            json= { "skus":sku_params },
+            timeout = API_TIMEOUT,
+            ok_statuses = (200,) + REJECTED_STATUSES
+        )
+        if resp is None:
+            return None
+        if resp.status_code in REJECTED_STATUSES:
+            raise BatchRejected(resp.status_code)
+        return resp.json()
     
+    def refresh_products(self, products):
+        bulk_skus = []
+        product_skus = []
+        tracker = DirtyTracker(PRICE_UPDATE_FIELDS)
+        history = PriceHistoryRecorder()
+        
+        for product in products:
+            tracker.track(product)
+            history.track(product)
+            if product.is_variant:
+                skus = (product.skus or "").split(",")
+            else:
+                skus = (product.skus or "").split(",")[:1]
+        
+            bulk_skus.extend(skus)
+            product_skus.append(skus)
+        
+        price_index = self.price_fetcher.fetch(bulk_skus)
+        
+        # a product none of whose SKUs came back keeps its stored prices, a variant missing from the answer
+        # keeps its own
+        priced = [product for product, skus in zip(products, product_skus) if any(sku in price_index for sku in skus)]
+        for product in priced:
+            if product.is_variant:
+                print(f"*** {product.orig_id} is updated.  : Deal : {product.is_deal}")
+                try:
+                    old_variants = json.loads(product.variants.replace("'", '"'))
+                except json.JSONDecodeError as e:
+                    old_variants = [] 
+    
+                new_variants = []
+    
+                try:
+                    for variant in old_variants:
+                        try:
+                            sku_value = price_index.get(str(variant["sku"])) if variant["attributes"] != {} else None
+                            variant["regular_price"], variant["sale_price"], variant["stock"] = parse_price_record(sku_value)
+                            new_variants.append(variant)
+                        except:
+                            new_variants.append(variant)
+                            continue
+                except Exception as e:
+                    print(e)
+    
+                product.variants = json.dumps(new_variants)
+            else:
+                print(f"***{product.orig_id} is updated.  : Deal : {product.is_deal}")
+                sku_value = price_index.get(product.skus.split(",")[0])
+                regular_price, sale_price, stock = parse_price_record(sku_value)
+    
+                product.regular_price = regular_price
+                product.sale_price = sale_price
+                product.stock = stock
+        changed = tracker.flush(Product)
+        recorded = history.flush(changed)
+        print(f"{len(changed)} of {len(products)} products changed, {len(recorded)} price history rows")
+        # a SKU the API answered without a price is checked too (discontinued, refused), so it ages like the rest;
+        # only a batch that got no answer at all leaves its products to be picked again
+        checked = [product for product, skus in zip(products, product_skus) if not any(sku in self.price_fetcher.unanswered for sku in skus)]
+        self.record_checks(checked, changed)
+        return checked
+
+    def record_checks(self, products, changed):
+        # change_rate is an exponential moving average of how often a check found a new price or stock
+        now = timezone.now()
+        changed_ids = {product.id for product in changed}
+        for product in products:
+            product.last_checked = now
+            product.change_rate = (1 - CHANGE_RATE_ALPHA) * (product.change_rate or 0) + CHANGE_RATE_ALPHA * (1 if product.id in changed_ids else 0)
+        Product.objects.bulk_update(products, ['last_checked', 'change_rate'], batch_size=500)
+
+    def get_products(self):
+        return Product.objects.filter(site = self.site, orig_id__isnull = False).only("id", "orig_id", "skus", "is_variant", "is_deal", "last_checked", "change_rate", *PRICE_UPDATE_FIELDS)
+
+    def sweep(self):
+        batch_size = SWEEP_WINDOW
+        # seek on the (site, orig_id) index from the last orig_id done, so each batch costs the same and a
+        # restarted sweep carries on where the previous process stopped
+        cursor, _ = SweepCursor.objects.get_or_create(site=self.site, name="price")
+        if cursor.position:
+            print(f"Resuming sweep after : {cursor.position}")
+        
+        while True:
+            products = self.get_products()
+            if cursor.position:
+                products = products.filter(orig_id__gt = cursor.position)
+            products = list(products.order_by('orig_id')[:batch_size])
+            if len(products) == 0:
+                break
+            self.refresh_products(products)
+            cursor.position = products[-1].orig_id
+            cursor.save(update_fields=['position', 'updated_at'])
+
+        cursor.position = None
+        cursor.save(update_fields=['position', 'updated_at'])
+
+    def get_priority(self, product, now):
+        # expected staleness: time since the last check weighted by how often the product changes,
+        # boosted for deals and for stock that is about to run out
+        if product.last_checked is None:
+            return math.inf
+        weight = 1 + CHANGE_RATE_WEIGHT * (product.change_rate or 0)
+        if product.is_deal:
+            weight *= DEAL_WEIGHT
+        if product.stock is not None and 0 < product.stock <= LOW_STOCK:
+            weight *= LOW_STOCK_WEIGHT
+        return (now - product.last_checked).total_seconds() * weight
+
+    def refresh_by_priority(self):
+        # candidates come from the indexes: never checked, longest unchecked, fastest changing, and every deal
+        now = timezone.now()
+        candidate_fields = ("id", "last_checked", "change_rate", "is_deal", "stock")
+        candidates = {}
+        products = Product.objects.filter(site = self.site, orig_id__isnull = False).only(*candidate_fields)
+        for queryset in [
+            products.filter(last_checked__isnull = True)[:REFRESH_BATCH],
+            products.filter(last_checked__isnull = False).order_by('last_checked')[:CANDIDATE_POOL],
+            products.filter(change_rate__gt = 0).order_by('-change_rate')[:CANDIDATE_POOL],
+            products.filter(is_deal = True)[:CANDIDATE_POOL],
+        ]:
+            for product in queryset:
+                candidates[product.id] = product
+        due = [product for product in candidates.values() if product.last_checked is None or (now - product.last_checked).total_seconds() >= MIN_RECHECK]
+        if len(due) == 0:
+            return 0
+        selected = heapq.nlargest(REFRESH_BATCH, due, key=lambda product: self.get_priority(product, now))
+        products = list(self.get_products().filter(id__in = [product.id for product in selected]))
+        print(f"Refreshing {len(products)} of {len(candidates)} candidates")
+        # 0 when the API answered none of them, so the caller waits before trying again
+        return len(self.refresh_products(products))
+
     def start(self):
         while True:
             print(f"Updating Price for Site : {self.settings['domain']}")
             self.site = self.get_site(self.settings["name"])
-            
-            batch_size = 50
-            total_count = Product.objects.filter(site=self.site).count()
-            
-            for offset in range(0, total_count, batch_size):
-                bulk_skus = []
-                products = Product.objects.filter(site = self.site).order_by('orig_id')[offset:offset+batch_size]
-                
-                for product in products:
-                    if product.is_variant:
-                        skus = product.skus.split(",")
-                    else:
-                        skus = product.skus.split(",")[:1]
-                        
-                    bulk_skus.extend(skus)
-                    
-                sku_params = []
-                
-                for sku in bulk_skus:
-                    sku_params.append({"code":str(sku), "lowStockThreshold":"0"})
-
-                result = self.get_price_response(sku_params)
-                
-                if result is not None:
-                    prods = result["skus"]
-                    for product in products:
-                        if product.is_variant:
-                            print(f"*** {product.orig_id} is updated.  : Deal : {product.is_deal}")
-                            try:
-                                old_variants = json.loads(product.variants.replace("'", '"'))
-                            except json.JSONDecodeError as e:
-                                old_variants = [] 
-                                    
-                            new_variants = []
-                            
-                            try:
-                                for variant in old_variants:
-                                    try:
-                                        sku_value = next((item for item in prods if str(item["code"]) == variant["sku"] and variant["attributes"] != {}), None)
-                                        if "originalPrice" in sku_value and sku_value["originalPrice"] is not None and "value" in sku_value["originalPrice"] and sku_value["originalPrice"]["value"] is not None:
-                                            variant["regular_price"] = sku_value["originalPrice"]["value"]
-                                        else:
-                                            variant["regular_price"] = 0
-                                        if "currentPrice" in sku_value and "value" in sku_value["currentPrice"] and sku_value["currentPrice"]["value"] is not None:
-                                            variant["sale_price"] = sku_value["currentPrice"]["value"]
-                                        else:
-                                            variant["sale_price"] = 0
-                                        if "fulfillment" in sku_value and "availability" in sku_value["fulfillment"] and "Corporate" in sku_value["fulfillment"]["availability"] and "Quantity" in sku_value["fulfillment"]["availability"]["Corporate"]:
-                                            variant["stock"] = sku_value["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                                        elif "fulfillment" in sku_value and "availability" in sku_value["fulfillment"] and "quantity" in sku_value["fulfillment"]["availability"]:
-                                            variant["stock"] = sku_value["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                                        else:
-                                            variant["stock"] = 0   
-                                        new_variants.append(variant)
-                                    except:
-                                        new_variants.append(variant)
-                                        continue
-                            except Exception as e:
-                                print(e)
-                                
-                            product.variants = new_variants
-                        else:
-                            print(f"***{product.orig_id} is updated.  : Deal : {product.is_deal}")
-                            sku_value = next((item for item in prods if str(item["code"]) == product.skus.split(",")[0]), None)
-                            try:
-                                if "originalPrice" in sku_value and sku_value["originalPrice"] is not None and "value" in sku_value["originalPrice"] and sku_value["originalPrice"]["value"] is not None:
-                                    regular_price = sku_value["originalPrice"]["value"]
-                                else:
-                                    regular_price = 0
-                                if "currentPrice" in sku_value and "value" in sku_value["currentPrice"] and sku_value["currentPrice"]["value"] is not None:
-                                    sale_price = sku_value["currentPrice"]["value"]
-                                else:
-                                    sale_price = 0
-                                if "fulfillment" in sku_value and "availability" in sku_value["fulfillment"] and "Corporate" in sku_value["fulfillment"]["availability"] and "Quantity" in sku_value["fulfillment"]["availability"]["Corporate"]:
-                                    stock = sku_value["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                                elif "fulfillment" in sku_value and "availability" in sku_value["fulfillment"] and "quantity" in sku_value["fulfillment"]["availability"]:
-                                    stock = sku_value["fulfillment"]["availability"]["Corporate"]["Quantity"]
-                                else:
-                                    stock = 0
-                            
-                                product.regular_price = regular_price
-                                product.sale_price = sale_price
-                                product.stock = stock
-                            except:
-                                product.stock = 0
-                    Product.objects.bulk_update(products, ['sale_price', 'regular_price', 'stock', 'variants'])
-                else:
-                    continue
\ No newline at end of file
+            if self.settings.get("schedule", "priority") == "sweep":
+                self.sweep()
+            elif self.refresh_by_priority() == 0:
+                print(f"Nothing due or answered, sleeping {MIN_RECHECK}s")
+                time.sleep(MIN_RECHECK)
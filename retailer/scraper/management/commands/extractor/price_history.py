@@ -0,0 +1,63 @@
+import json
+from django.utils import timezone
+from scraper.models import PriceHistory
+
+def get_sku_prices(product):
+    # {sku: (sale_price, regular_price, stock)}, read from the variants JSON or from the product row
+    if product.is_variant:
+        try:
+            variants = json.loads(product.variants.replace("'", '"')) if product.variants else []
+        except json.JSONDecodeError:
+            variants = []
+        prices = {}
+        for variant in variants:
+            if isinstance(variant, dict) and "sku" in variant:
+                prices[str(variant["sku"])] = (variant.get("sale_price"), variant.get("regular_price"), variant.get("stock"))
+        return prices
+    if not product.skus:
+        skus = []
+    elif product.skus.startswith("["):
+        # kmstools stores its SKU as a JSON list
+        skus = json.loads(product.skus)
+    else:
+        skus = product.skus.split(",")
+    if len(skus) == 0:
+        return {}
+    return {str(skus[0]): (product.sale_price, product.regular_price, product.stock)}
+
+class PriceHistoryRecorder:
+    # remembers the prices of each product when it is loaded and appends a history row only for the SKUs
+    # whose price or stock differ at flush time, or that have no history yet so every SKU starts from a known
+    # price; all rows of a flush go in with one bulk insert
+    def __init__(self):
+        self.tracked = {}
+
+    def track(self, product):
+        self.tracked[product.id] = (product, get_sku_prices(product))
+
+    def flush(self, products, batch_size = 500):
+        # products are the ones written since they were tracked (new ones included), the other tracked
+        # products only get their starting row
+        now = timezone.now()
+        current = {product.id: product for product, _ in self.tracked.values()}
+        current.update((product.id, product) for product in products if product.id is not None)
+        recorded = set()
+        if len(current) > 0:
+            recorded = set(PriceHistory.objects.filter(product_id__in=list(current)).values_list("product_id", "sku").distinct())
+        rows = []
+        for product in current.values():
+            before = self.tracked[product.id][1] if product.id in self.tracked else {}
+            for sku, prices in get_sku_prices(product).items():
+                if before.get(sku) != prices or (product.id, sku) not in recorded:
+                    rows.append(PriceHistory(
+                        product_id = product.id,
+                        sku = sku,
+                        recorded_at = now,
+                        sale_price = prices[0],
+                        regular_price = prices[1],
+                        stock = prices[2]
+                    ))
+        self.tracked = {}
+        if len(rows) > 0:
+            PriceHistory.objects.bulk_create(rows, batch_size=batch_size)
+        return rows
@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from django.conf import settings
+
+CACHE_DIR = settings.BASE_DIR / "http_cache"
+CACHE_TTL = 24 * 60 * 60
+
+class ResponseCache:
+    # JSON payloads on disk, one file per sha256 of (url, params); fresh entries are served without a request,
+    # stale ones are revalidated with If-None-Match when the server gave us an ETag
+    def __init__(self, root = CACHE_DIR, ttl = CACHE_TTL):
+        self.root = Path(root)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.lock = threading.Lock()
+
+    def get_path(self, url, params):
+        key = hashlib.sha256(json.dumps([url, params], sort_keys=True).encode("utf-8")).hexdigest()
+        return self.root / key[:2] / f"{key}.json"
+
+    def load(self, path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, path, body, etag):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"fetched_at": time.time(), "etag": etag, "body": body}, f)
+        os.replace(tmp_path, path)
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get_json(self, url, params, fetch):
+        # fetch(headers) sends the request with the extra headers and returns the response, or None on failure
+        path = self.get_path(url, params)
+        entry = self.load(path)
+        if entry is not None and time.time() - entry["fetched_at"] < self.ttl:
+            self.count("hits")
+            return entry["body"]
+        headers = {}
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        resp = fetch(headers)
+        if resp is None:
+            return None
+        if resp.status_code == 304 and entry is not None:
+            self.count("revalidated")
+            self.save(path, entry["body"], entry["etag"])
+            return entry["body"]
+        self.count("misses")
+        body = resp.json()
+        self.save(path, body, resp.headers.get("ETag"))
+        return body
+
+    def report(self):
+        total = self.hits + self.misses + self.revalidated
+        ratio = (self.hits + self.revalidated) / total * 100 if total > 0 else 0
+        return f"response cache : {self.hits} hits, {self.revalidated} revalidated, {self.misses} misses ({ratio:.1f}% served from cache)"
@@ -0,0 +1,125 @@
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import requests
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RATE = 20
+MAX_BACKOFF = 60
+BREAKER_ERRORS = 10
+BREAKER_WINDOW = 30
+BREAKER_COOLDOWN = 60
+
+class HostThrottle:
+    # token bucket for the request rate plus an AIMD window for the number of requests in flight:
+    # every success widens the window by about one request per round, every 429/5xx/timeout halves it,
+    # and a burst of errors opens the breaker and pauses the host entirely
+    def __init__(self, host, max_concurrency = DEFAULT_CONCURRENCY, rate = DEFAULT_RATE):
+        self.host = host
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.rate = rate
+        self.tokens = float(rate)
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0
+        self.errors = deque()
+        self.condition = threading.Condition()
+
+    def refill(self, now):
+        self.tokens = min(self.rate, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+                if now < self.paused_until:
+                    self.condition.wait(self.paused_until - now)
+                elif self.in_flight >= int(self.concurrency):
+                    self.condition.wait()
+                elif self.tokens < 1:
+                    self.condition.wait((1 - self.tokens) / self.rate)
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+
+    def release(self, failed, retry_after = None):
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if failed:
+                self.concurrency = max(1.0, self.concurrency / 2)
+                if retry_after is not None:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+                self.errors.append(now)
+                while len(self.errors) > 0 and self.errors[0] < now - BREAKER_WINDOW:
+                    self.errors.popleft()
+                if len(self.errors) >= BREAKER_ERRORS:
+                    print(f"{self.host} : {len(self.errors)} errors in {BREAKER_WINDOW}s, pausing for {BREAKER_COOLDOWN}s")
+                    self.paused_until = max(self.paused_until, now + BREAKER_COOLDOWN)
+                    self.errors.clear()
+            else:
+                self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+            self.condition.notify_all()
+
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+def host_throttle(url, max_concurrency = DEFAULT_CONCURRENCY, rate = DEFAULT_RATE):
+    # one throttle per host, shared by every scraper and thread in the process
+    host = urlsplit(url).netloc
+    with _throttles_lock:
+        if host not in _throttles:
+            _throttles[host] = HostThrottle(host, max_concurrency, rate)
+        return _throttles[host]
+
+def is_retryable(status_code):
+    return status_code in (408, 429) or status_code >= 500
+
+def get_retry_after(resp):
+    value = resp.headers.get("Retry-After") if resp is not None else None
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def throttled_request(session, method, url, label = "", max_retries = 5, delay = 2, max_concurrency = DEFAULT_CONCURRENCY, rate = DEFAULT_RATE, ok_statuses = (200,), **kwargs):
+    # returns the first response with one of ok_statuses, or None once the retries are used up or the server rejects the request outright
+    throttle = host_throttle(url, max_concurrency, rate)
+    for attempt in range(1, max_retries + 1):
+        resp = None
+        throttle.acquire()
+        try:
+            resp = session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            print(f"Request failed: {e}")
+        finally:
+            failed = resp is None or is_retryable(resp.status_code)
+            retry_after = get_retry_after(resp)
+            throttle.release(failed, retry_after)
+        if resp is not None:
+            if resp.status_code in ok_statuses:
+                return resp
+            if not is_retryable(resp.status_code):
+                print(f"{label}Request rejected with status {resp.status_code}")
+                return None
+        if attempt == max_retries:
+            break
+        # exponential backoff with full jitter, never shorter than what the server asked for
+        backoff = random.uniform(0, min(MAX_BACKOFF, delay * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            backoff = max(backoff, retry_after)
+        print(f"{label}Retrying... ({attempt}/{max_retries})")
+        time.sleep(backoff)
+    print("Max retries reached. Could not get a successful response.")
+    return None
@@ -7,6 +7,14 @@ class Command(BaseCommand):
     help = "Scrape all categories and products from other site"
     def add_arguments(self, parser: CommandParser) -> None:
         parser.add_argument("site", type=str, help="Name of the site")
+        parser.add_argument("--concurrency", type=int, help="Max parallel requests per host")
+        parser.add_argument("--rate-limit", type=float, help="Max requests per second per host")
+        parser.add_argument("--workers", type=int, help="Number of leaf categories crawled in parallel, or of page parser processes for kmstools")
+        parser.add_argument("--cache-dir", type=str, help="Directory of the on-disk response cache")
+        parser.add_argument("--cache-ttl", type=int, help="Seconds a cached response is served without revalidation")
+        parser.add_argument("--deal-threshold", type=float, help="Minimum discount in percent for a deal, categories can override it")
+        parser.add_argument("--parse-mode", type=str, choices=["tree", "stream"], help="kmstools product pages: full parse in worker processes, or streamed partial parse")
+        parser.add_argument("--schedule", type=str, choices=["priority", "sweep"], help="Price refresh order: most stale first, or a full sweep")
     
     def handle(self, *args, **options):
         site_name = options['site']
@@ -198,8 +206,33 @@ class Command(BaseCommand):
                 "url": "https://www.kmstools.com",
                 "label": "kmstools",
             })
+        elif site_name == "refresh_kmstools":
+            scraper = KmstoolsScraper()
+            scraper.set_settings({
+                "name": "kmstools",
+                "domain": "kmstools.com",
+                "url": "https://www.kmstools.com",
+                "label": "kmstools",
+                "mode": "refresh",
+            })
         else:
             print(f"scraper script for {site_name} not found")
             return
+        if options["concurrency"] is not None:
+            scraper.settings["concurrency"] = options["concurrency"]
+        if options["rate_limit"] is not None:
+            scraper.settings["rate_limit"] = options["rate_limit"]
+        if options["workers"] is not None:
+            scraper.settings["workers"] = options["workers"]
+        if options["cache_dir"] is not None:
+            scraper.settings["cache_dir"] = options["cache_dir"]
+        if options["cache_ttl"] is not None:
+            scraper.settings["cache_ttl"] = options["cache_ttl"]
+        if options["deal_threshold"] is not None:
+            scraper.settings["deal_threshold"] = options["deal_threshold"]
+        if options["parse_mode"] is not None:
+            scraper.settings["parse_mode"] = options["parse_mode"]
+        if options["schedule"] is not None:
+            scraper.settings["schedule"] = options["schedule"]
         scraper.start()
         
\ No newline at end of file
@@ -0,0 +1,47 @@
+# Generated by Django 5.0.7 on 2026-10-18 08:21
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicates(apps, schema_editor):
+    Category = apps.get_model('scraper', 'Category')
+    Product = apps.get_model('scraper', 'Product')
+    # keep the oldest row of each (site, orig_id) and move everything that points at the copies onto it
+    duplicates = Category.objects.exclude(orig_id=None).values('site', 'orig_id').annotate(keep=Min('id'), total=Count('id')).filter(total__gt=1)
+    for duplicate in duplicates:
+        # plain ids: MySQL rejects an UPDATE of wp_categories filtered by a subquery on wp_categories (error 1093)
+        ids = list(Category.objects.filter(site=duplicate['site'], orig_id=duplicate['orig_id']).exclude(id=duplicate['keep']).values_list('id', flat=True))
+        Category.objects.filter(parent_id__in=ids).update(parent_id=duplicate['keep'])
+        Product.objects.filter(category_id__in=ids).update(category_id=duplicate['keep'])
+        Category.objects.filter(id__in=ids).delete()
+    duplicates = Product.objects.exclude(orig_id=None).values('site', 'orig_id').annotate(keep=Min('id'), total=Count('id')).filter(total__gt=1)
+    for duplicate in duplicates:
+        copies = Product.objects.filter(site=duplicate['site'], orig_id=duplicate['orig_id'])
+        # a copy already published to the mall keeps its wwmall_id link and status, otherwise the oldest stays
+        keep = copies.exclude(wwmall_id=None).order_by('id').values_list('id', flat=True).first() or duplicate['keep']
+        copies.exclude(id=keep).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0009_product_is_deal'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='category',
+            name='orig_id',
+            field=models.CharField(blank=True, max_length=150, null=True),
+        ),
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='category',
+            constraint=models.UniqueConstraint(fields=('site', 'orig_id'), name='category_site_orig_id'),
+        ),
+        migrations.AddConstraint(
+            model_name='product',
+            constraint=models.UniqueConstraint(fields=('site', 'orig_id'), name='product_site_orig_id'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 08:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0010_site_orig_id_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='total_pages',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.7 on 2026-10-18 08:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0011_category_total_pages'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SweepCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('position', models.CharField(blank=True, max_length=150, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('site', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='scraper.website')),
+            ],
+            options={
+                'db_table': 'wp_sweep_cursors',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='sweepcursor',
+            constraint=models.UniqueConstraint(fields=('site', 'name'), name='sweep_cursor_site_name'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.7 on 2026-10-18 08:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0012_sweepcursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='change_rate',
+            field=models.FloatField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='last_checked',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.0.7 on 2026-10-18 08:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0013_product_last_checked'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sku', models.CharField(max_length=50)),
+                ('recorded_at', models.DateTimeField()),
+                ('sale_price', models.FloatField(blank=True, null=True)),
+                ('regular_price', models.FloatField(blank=True, null=True)),
+                ('stock', models.IntegerField(blank=True, null=True)),
+                ('product', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='scraper.product')),
+            ],
+            options={
+                'db_table': 'wp_price_history',
+                'indexes': [models.Index(fields=['sku', 'recorded_at'], name='price_history_sku_time'), models.Index(fields=['product', 'recorded_at'], name='price_history_product_time'), models.Index(fields=['recorded_at'], name='price_history_time')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 08:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0014_pricehistory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='deal_threshold',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -17,14 +17,19 @@ class Category(models.Model):
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
     name = models.CharField(max_length=100, null=True, blank=True)
     url = models.TextField(null=True, blank=True)
-    orig_id = models.TextField(null=True, blank=True)
+    orig_id = models.CharField(max_length=150, null=True, blank=True)
     status = models.CharField(max_length=10, default='0')
     role = models.CharField(max_length=10, null=True, blank=True, choices=ROLES)
     level = models.IntegerField(null=True, blank=True)
     google_path = models.CharField(max_length=300, null=True, blank=True)
     orig_path = models.CharField(max_length=300, null=True, blank=True)
+    total_pages = models.IntegerField(null=True, blank=True)
+    deal_threshold = models.FloatField(null=True, blank=True)
     class Meta:
         db_table = 'wp_categories'
+        constraints = [
+            models.UniqueConstraint(fields=['site', 'orig_id'], name='category_site_orig_id'),
+        ]
 
     def __str__(self):
         return self.name if self.name else str(self.id)
@@ -53,9 +58,48 @@ class Product(models.Model):
     variants = models.TextField(null=True, blank=True)
 
     is_deal = models.BooleanField(null=True, blank=True)
+    last_checked = models.DateTimeField(null=True, blank=True, db_index=True)
+    change_rate = models.FloatField(default=0, db_index=True)
     
     class Meta:
         db_table = 'wp_products'
+        constraints = [
+            models.UniqueConstraint(fields=['site', 'orig_id'], name='product_site_orig_id'),
+        ]
 
     def __str__(self):
-        return self.name if self.name else str(self.id)
\ No newline at end of file
+        return self.name if self.name else str(self.id)
+
+class PriceHistory(models.Model):
+    # one row per SKU each time its price or stock changes; the (sku, recorded_at) and (product, recorded_at)
+    # indexes answer "price at time T" with one seek and recorded_at alone answers "changes since T"
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, db_index=False)
+    sku = models.CharField(max_length=50)
+    recorded_at = models.DateTimeField()
+    sale_price = models.FloatField(null=True, blank=True)
+    regular_price = models.FloatField(null=True, blank=True)
+    stock = models.IntegerField(null=True, blank=True)
+    class Meta:
+        db_table = 'wp_price_history'
+        indexes = [
+            models.Index(fields=['sku', 'recorded_at'], name='price_history_sku_time'),
+            models.Index(fields=['product', 'recorded_at'], name='price_history_product_time'),
+            models.Index(fields=['recorded_at'], name='price_history_time'),
+        ]
+
+    def __str__(self):
+        return f"{self.sku} {self.recorded_at}"
+
+class SweepCursor(models.Model):
+    site = models.ForeignKey(Website, on_delete=models.CASCADE)
+    name = models.CharField(max_length=50)
+    position = models.CharField(max_length=150, null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    class Meta:
+        db_table = 'wp_sweep_cursors'
+        constraints = [
+            models.UniqueConstraint(fields=['site', 'name'], name='sweep_cursor_site_name'),
+        ]
+
+    def __str__(self):
+        return f"{self.site} {self.name}"
\ No newline at end of file
@@ -1,3 +1,283 @@
-from django.test import TestCase
+import json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from scraper.models import Website, Category, Product, PriceHistory
+from scraper.management.commands.extractor.category_tree import sync_category_tree
+from scraper.management.commands.extractor.price_api import PriceFetcher, BatchRejected
+from scraper.management.commands.extractor.price_history import PriceHistoryRecorder
+from scraper.management.commands.extractor.deals import evaluate_deals, load_deal_thresholds
+from scraper.management.commands.extractor.price_canadiantire_class import PriceCanadianTireScraper
+from scraper.management.commands.extractor.kmstools import KmstoolsScraper
+from scraper.management.commands.extractor.kms_parser import parse_product_page, stream_product_page
 
-# Create your tests here.
+# saved kmstools product pages, also the input of the benchkms command
+KMS_PAGES = Path(__file__).resolve().parent / "testdata" / "kmspages"
+
+
+def category_node(orig_id, parent, url = ""):
+    path = f"{parent} > {orig_id}" if parent else orig_id
+    return {"orig_id": orig_id, "parent": parent, "name": orig_id, "url": url, "role": "", "level": path.count(">") + 1, "orig_path": path}
+
+
+class SyncCategoryTreeTests(TestCase):
+    def setUp(self):
+        self.site = Website.objects.create(name="site")
+
+    def stored(self):
+        return {category.orig_id: category for category in Category.objects.filter(site=self.site)}
+
+    def test_moves_a_category_to_its_new_parent(self):
+        sync_category_tree(self.site, [category_node("A", None), category_node("C", None), category_node("B", "A")])
+        sync_category_tree(self.site, [category_node("A", None), category_node("C", None), category_node("B", "C")])
+        stored = self.stored()
+        self.assertEqual(stored["B"].parent_id, stored["C"].id)
+        self.assertEqual(stored["B"].orig_path, "C > B")
+
+    def test_duplicate_orig_id_keeps_the_last_node(self):
+        sync_category_tree(self.site, [category_node("A", None), category_node("B", "A", "first"), category_node("B", "A", "last")])
+        stored = self.stored()
+        self.assertEqual(len(stored), 2)
+        self.assertEqual(stored["B"].url, "last")
+
+    def test_second_sync_writes_nothing(self):
+        nodes = [category_node("A", None), category_node("B", "A"), category_node("C", "B")]
+        sync_category_tree(self.site, nodes)
+        with CaptureQueriesContext(connection) as queries:
+            sync_category_tree(self.site, nodes)
+        self.assertEqual([query["sql"] for query in queries.captured_queries if not query["sql"].startswith(("SELECT", "SAVEPOINT", "RELEASE"))], [])
+
+
+class FakePriceApi:
+    # answers every SKU of a batch, refuses batches over max_size or holding a bad SKU, and fails every batch while down
+    def __init__(self, max_size = 1000, down = False, bad = ()):
+        self.max_size = max_size
+        self.down = down
+        self.bad = set(bad)
+        self.calls = []
+
+    def post(self, sku_params):
+        self.calls.append(len(sku_params))
+        if self.down:
+            return None
+        if len(sku_params) > self.max_size:
+            raise BatchRejected(413)
+        if any(param["code"] in self.bad for param in sku_params):
+            raise BatchRejected(400)
+        return {"skus": [{"code": param["code"]} for param in sku_params]}
+
+
+class PriceFetcherTests(SimpleTestCase):
+    def test_fetches_every_sku(self):
+        api = FakePriceApi()
+        price_map = PriceFetcher(api.post).fetch(range(1000))
+        self.assertEqual(set(price_map), {str(sku) for sku in range(1000)})
+
+    def test_grows_batches_while_the_api_answers(self):
+        api = FakePriceApi()
+        fetcher = PriceFetcher(api.post, depth=1)
+        fetcher.fetch(range(2000))
+        self.assertEqual(api.calls[0], 100)
+        self.assertGreater(max(api.calls), 100)
+        self.assertLessEqual(max(api.calls), 500)
+
+    def test_splits_batches_rejected_for_size(self):
+        api = FakePriceApi(max_size=60)
+        fetcher = PriceFetcher(api.post)
+        price_map = fetcher.fetch(range(1000))
+        self.assertEqual(len(price_map), 1000)
+        self.assertLessEqual(fetcher.batch_size, 60)
+        # the next run starts at the size that went through
+        api.calls = []
+        fetcher.fetch(range(1000))
+        self.assertLessEqual(max(api.calls), 60)
+
+    def test_outage_does_not_split(self):
+        api = FakePriceApi(down=True)
+        fetcher = PriceFetcher(api.post)
+        price_map = fetcher.fetch(range(500))
+        self.assertEqual(price_map, {})
+        self.assertEqual(api.calls, [100] * 5)
+        self.assertEqual(fetcher.batch_size, 100)
+        self.assertEqual(len(fetcher.unanswered), 500)
+
+    def test_bad_sku_costs_only_its_own_price(self):
+        api = FakePriceApi(bad={"1500"})
+        fetcher = PriceFetcher(api.post, depth=1)
+        price_map = fetcher.fetch(range(3000))
+        self.assertEqual(set(price_map), {str(sku) for sku in range(3000)} - {"1500"})
+        self.assertEqual(fetcher.unanswered, set())
+        # the ceiling the bad SKU set is lifted again
+        for _ in range(3):
+            fetcher.fetch(range(3000, 9000))
+        self.assertGreater(fetcher.batch_size, 400)
+
+    def test_rejected_single_sku_is_left_out(self):
+        api = FakePriceApi(max_size=0)
+        price_map = PriceFetcher(api.post).fetch(["1"])
+        self.assertEqual(price_map, {})
+        self.assertEqual(api.calls, [1])
+
+
+class FakePriceFetcher:
+    # answers the SKUs in prices, gets no answer at all for those in unanswered and leaves out the rest
+    def __init__(self, prices, unanswered):
+        self.prices = prices
+        self.unanswered = set(unanswered)
+
+    def fetch(self, skus):
+        return {sku: {"code": sku, "originalPrice": {"value": 20}, "currentPrice": {"value": self.prices[sku]}} for sku in skus if sku in self.prices}
+
+
+class RefreshProductsTests(TestCase):
+    def test_only_answered_products_change(self):
+        site = Website.objects.create(name="site")
+        category = Category.objects.create(site=site, name="category", orig_id="1")
+        for sku in ["S1", "S2", "S3"]:
+            Product.objects.create(site=site, category=category, orig_id=sku, skus=sku, sale_price=10, regular_price=20, stock=3)
+        scraper = PriceCanadianTireScraper()
+        scraper.site = site
+        scraper.price_fetcher = FakePriceFetcher({"S1": 5}, ["S2"])
+        checked = scraper.refresh_products(list(scraper.get_products().order_by("orig_id")))
+        products = {product.orig_id: product for product in Product.objects.all()}
+        self.assertEqual((products["S1"].sale_price, products["S1"].stock), (5, 0))
+        # no answer: untouched and picked again
+        self.assertEqual((products["S2"].sale_price, products["S2"].stock, products["S2"].last_checked), (10, 3, None))
+        # answered without a price: untouched but checked
+        self.assertEqual((products["S3"].sale_price, products["S3"].stock), (10, 3))
+        self.assertIsNotNone(products["S3"].last_checked)
+        self.assertEqual([product.orig_id for product in checked], ["S1", "S3"])
+        # the starting row of S2 holds its stored price, not a made up one
+        self.assertEqual(list(PriceHistory.objects.filter(sku="S2").values_list("sale_price", "stock")), [(10, 3)])
+
+
+class PriceHistoryRecorderTests(TestCase):
+    def setUp(self):
+        site = Website.objects.create(name="site")
+        category = Category.objects.create(site=site, name="category", orig_id="1")
+        self.product = Product.objects.create(site=site, category=category, orig_id="1", skus="A", sale_price=10, regular_price=20, stock=3)
+
+    def flush(self, changed):
+        recorder = PriceHistoryRecorder()
+        recorder.track(self.product)
+        if changed:
+            self.product.sale_price -= 1
+        return recorder.flush([self.product] if changed else [])
+
+    def test_starts_the_history_of_an_unchanged_product(self):
+        self.assertEqual(len(self.flush(False)), 1)
+        self.assertEqual(len(self.flush(False)), 0)
+
+    def test_records_changes_only(self):
+        self.flush(False)
+        self.flush(True)
+        self.flush(False)
+        self.assertEqual(list(PriceHistory.objects.order_by("id").values_list("sku", "sale_price")), [("A", 10), ("A", 9)])
+
+
+class EvaluateDealsTests(SimpleTestCase):
+    def test_products_without_prices(self):
+        # product 1 has no SKU in the middle of the batch, product 3 none at the end
+        best, deals = evaluate_deals([100, 100, 50], [60, 90, 40], [2, 0, 1, 0], [30, 30, 30, 30])
+        self.assertEqual(best.tolist(), [40, 0, 20, 0])
+        self.assertEqual(deals.tolist(), [True, False, False, False])
+
+    def test_sale_not_below_regular_is_no_discount(self):
+        best, deals = evaluate_deals([100, 100, 0], [100, 120, 10], [1, 1, 1], [0.5, 0.5, 0.5])
+        self.assertEqual(best.tolist(), [0, 0, 0])
+        self.assertEqual(deals.tolist(), [False, False, False])
+
+    def test_empty_batch(self):
+        best, deals = evaluate_deals([], [], [], [])
+        self.assertEqual(len(best), 0)
+
+
+class DealThresholdTests(TestCase):
+    def test_thresholds_come_from_the_nearest_ancestor(self):
+        site = Website.objects.create(name="site")
+        root = Category.objects.create(site=site, orig_id="root")
+        tools = Category.objects.create(site=site, orig_id="tools", parent=root, deal_threshold=40)
+        saws = Category.objects.create(site=site, orig_id="saws", parent=tools)
+        blades = Category.objects.create(site=site, orig_id="blades", parent=saws, deal_threshold=10)
+        thresholds = load_deal_thresholds(site, 25)
+        self.assertEqual(thresholds, {root.id: 25, tools.id: 40, saws.id: 40, blades.id: 10})
+
+
+class KmsParserTests(SimpleTestCase):
+    def setUp(self):
+        self.text = (KMS_PAGES / "product.html").read_bytes()
+
+    def test_parses_a_saved_product_page(self):
+        page = parse_product_page(self.text)
+        self.assertEqual(page["regular_price"], "1249.99")
+        self.assertEqual(page["images"], ["https://www.kmstools.com/media/catalog/product/blade-1.jpg", "https://www.kmstools.com/media/catalog/product/blade-2.jpg"])
+        self.assertTrue(page["description"].startswith('<div class="marketing_text"><p>Thin kerf'))
+
+    def test_not_a_product_page(self):
+        self.assertIsNone(parse_product_page(b"<html><body><div id='maincontent'></div></body></html>"))
+
+    def test_stream_matches_tree(self):
+        for size in [64, 1024, len(self.text)]:
+            chunks = (self.text[i:i + size] for i in range(0, len(self.text), size))
+            self.assertEqual(stream_product_page(chunks), parse_product_page(self.text))
+
+
+KMS_PRODUCT_PAGE = """<html><head>
+<script type="text/x-magento-init">{"[data-gallery-role=gallery-placeholder]": {"mage/gallery/gallery": {"data": [{"img": "https://img/1.jpg"}]}}}</script>
+</head><body><div id="maincontent"><div class="columns"><div class="main"><div class="product-info-main">
+<div class="product-info-price"><div class="price-box"><span class="old-price"><span class="price-container">
+<span class="price-wrapper">$1,019.99</span></span></span></div></div>
+</div></div></div></div>
+<div id="product.info.description"><div class="marketing_text"><p>Saw</p></div></div>
+</body></html>"""
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+    encoding = "utf-8"
+
+    def __init__(self, text):
+        self.content = text.encode("utf-8")
+
+    def iter_content(self, chunk_size = 1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeKmsSession:
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((url, kwargs))
+        return FakeResponse(KMS_PRODUCT_PAGE)
+
+
+class KmstoolsStreamTests(TestCase):
+    def test_stream_mode_creates_products(self):
+        site = Website.objects.create(name="kmstools")
+        category = Category.objects.create(site=site, name="Saws", orig_id="Saws_2")
+        scraper = KmstoolsScraper()
+        scraper.set_settings({"name": "kmstools", "domain": "kmstools.com", "url": "https://www.kmstools.com", "label": "kmstools", "parse_mode": "stream"})
+        scraper.session = FakeKmsSession()
+        scraper.fetch_executor = ThreadPoolExecutor(max_workers=2)
+        products = [
+            Product(site=site, category=category, orig_id=str(orig_id), url=f"https://www.kmstools.com/item-{orig_id}.html", skus=json.dumps([f"S{orig_id}"]), sale_price=10, stock=1)
+            for orig_id in range(2)
+        ]
+        try:
+            scraper.create_products(products)
+        finally:
+            scraper.fetch_executor.shutdown()
+        self.assertEqual(Product.objects.filter(site=site).count(), 2)
+        self.assertTrue(all(kwargs.get("stream") for _, kwargs in scraper.session.requests))
+        product = Product.objects.get(site=site, orig_id="0")
+        self.assertEqual(product.regular_price, 1019.99)
+        self.assertEqual(json.loads(product.images), ["https://img/1.jpg"])
+        self.assertIn("Saw", product.description)